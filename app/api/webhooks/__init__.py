@@ -3,5 +3,6 @@ Webhooks para canales de comunicación.
 """
 
 from app.api.webhooks.whatsapp import router as whatsapp_router
+from app.api.webhooks.voice import router as voice_router
 
-__all__ = ["whatsapp_router"]
\ No newline at end of file
+__all__ = ["whatsapp_router", "voice_router"]
\ No newline at end of file
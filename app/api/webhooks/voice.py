@@ -3,29 +3,22 @@ Webhook para Twilio Voice.
 """
 
 from fastapi import APIRouter, Request
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, Response
+from xml.sax.saxutils import escape
+from typing import Optional
+import re
 import structlog
 
 from app.services.voice_service import speech_to_text
 from app.services.ai_service import generate_ai_response
+from app.utils.forms import fast_form
 
 router = APIRouter()
 logger = structlog.get_logger()
 
-
-@router.post("/voice", response_class=PlainTextResponse)
-async def voice_webhook(request: Request):
-    """
-    Recibe llamadas entrantes de Twilio Voice.
-    """
-    form_data = await request.form()
-    
-    call_sid = form_data.get("CallSid", "")
-    from_number = form_data.get("From", "")
-    
-    print(f"📞 LLAMADA RECIBIDA: {from_number}")
-    
-    twiml = """<?xml version="1.0" encoding="UTF-8"?>
+# TwiML pre-codificado: el saludo es estático y las demás respuestas
+# solo sustituyen un mensaje entre un prefijo y un sufijo fijos.
+_GREETING_TWIML = """<?xml version="1.0" encoding="UTF-8"?>
 <Response>
     <Say language="es-MX" voice="Polly.Mia">
         Hola, gracias por llamar. ¿En qué puedo ayudarte?
@@ -40,9 +33,67 @@ async def voice_webhook(request: Request):
         No escuché nada. Hasta pronto.
     </Say>
     <Hangup/>
-</Response>"""
+</Response>""".encode("utf-8")
+
+_REPLY_PREFIX = """<?xml version="1.0" encoding="UTF-8"?>
+<Response>
+    <Say language="es-MX" voice="Polly.Mia">""".encode("utf-8")
+
+_REPLY_SUFFIX = """</Say>
+    <Pause length="1"/>
+    <Say language="es-MX" voice="Polly.Mia">¿Algo más?</Say>
+    <Record 
+        maxLength="20" 
+        action="/webhook/voice/process"
+        playBeep="false"
+        timeout="3"
+    />
+    <Say language="es-MX" voice="Polly.Mia">
+        Gracias por llamar. Hasta pronto.
+    </Say>
+    <Hangup/>
+</Response>""".encode("utf-8")
+
+_HANGUP_PREFIX = _REPLY_PREFIX
+
+_HANGUP_SUFFIX = """</Say>
+    <Hangup/>
+</Response>""".encode("utf-8")
+
+# Respuesta fija del callback de estado de grabación
+_STATUS_OK = b'{"status":"ok"}'
+
+# Frases de despedida: una sola pasada sobre la transcripción
+_FAREWELL_RE = re.compile(
+    r"\b(adiós|adios|gracias|hasta luego|bye|chao|no nada más|no nada mas|eso es todo)\b",
+    re.IGNORECASE
+)
+
+# Cierres repetitivos que el modelo agrega al final de la respuesta
+_CLEANUP_RE = re.compile(r"¿Hay algo más en (?:lo que|que) (?:pueda ayudarte|te pueda ayudar)\?")
+
+
+@router.post("/voice", response_class=PlainTextResponse)
+async def voice_webhook(request: Request):
+    """
+    Recibe llamadas entrantes de Twilio Voice.
+    """
+    form_data = await fast_form(request)
     
-    return PlainTextResponse(content=twiml, media_type="application/xml")
+    call_sid = form_data.get("CallSid", "")
+    from_number = form_data.get("From", "")
+    
+    logger.info("voice_call_received", call_sid=call_sid, from_number=from_number)
+    
+    return PlainTextResponse(content=_GREETING_TWIML, media_type="application/xml")
+
+
+def _parse_duration(value) -> Optional[float]:
+    """RecordingDuration de Twilio en segundos, o None si falta o no es numérico."""
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
 
 
 @router.post("/voice/process", response_class=PlainTextResponse)
@@ -50,78 +101,53 @@ async def process_voice(request: Request):
     """
     Procesa la grabación del usuario.
     """
-    form_data = await request.form()
+    form_data = await fast_form(request)
     
     recording_url = form_data.get("RecordingUrl", "")
+    recording_duration = form_data.get("RecordingDuration")
     
-    print(f"🎙️ PROCESANDO AUDIO: {recording_url}")
+    logger.info("voice_recording_received", recording_url=recording_url, duration=recording_duration)
     
     if not recording_url:
         return _hangup_response("No pude escucharte. Hasta pronto.")
     
     # 1. Transcribir audio con Whisper
-    print("🔄 Transcribiendo con Whisper...")
-    user_text = await speech_to_text(recording_url)
+    user_text = await speech_to_text(recording_url, duration=_parse_duration(recording_duration))
     
     if not user_text:
         return _hangup_response("No pude entender. Hasta pronto.")
     
-    print(f"✅ TRANSCRIPCIÓN: {user_text}")
+    logger.info("voice_transcription", text_preview=user_text[:50])
     
     # Detectar despedida
-    despedidas = ["adiós", "adios", "gracias", "hasta luego", "bye", "chao", "no nada más", "no nada mas", "eso es todo"]
-    if any(d in user_text.lower() for d in despedidas):
+    if _FAREWELL_RE.search(user_text):
         return _hangup_response("Gracias por llamar. Hasta pronto.")
     
-    # 2. Generar respuesta con IA
-    print("🤖 Generando respuesta con GPT-4...")
+    # 2. Generar respuesta con IA (cacheada por generate_ai_response)
     response = await generate_ai_response(
         user_message=user_text,
         company_id="demo_company"
     )
     
-    ai_text = response.message
     # Limpiar respuesta para evitar repeticiones
-    ai_text = ai_text.replace("¿Hay algo más en lo que pueda ayudarte?", "")
-    ai_text = ai_text.replace("¿Hay algo más en que pueda ayudarte?", "")
-    ai_text = ai_text.replace("¿Hay algo más en lo que te pueda ayudar?", "")
-    ai_text = ai_text.strip()
+    ai_text = _CLEANUP_RE.sub("", response.message).strip()
     
-    print(f"✅ RESPUESTA IA: {ai_text}")
+    logger.info("voice_ai_response", response_preview=ai_text[:50])
     
     # 3. Responder y continuar conversación
-    twiml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<Response>
-    <Say language="es-MX" voice="Polly.Mia">{ai_text}</Say>
-    <Pause length="1"/>
-    <Say language="es-MX" voice="Polly.Mia">¿Algo más?</Say>
-    <Record 
-        maxLength="20" 
-        action="/webhook/voice/process"
-        playBeep="false"
-        timeout="3"
-    />
-    <Say language="es-MX" voice="Polly.Mia">
-        Gracias por llamar. Hasta pronto.
-    </Say>
-    <Hangup/>
-</Response>"""
+    twiml = _REPLY_PREFIX + escape(ai_text).encode("utf-8") + _REPLY_SUFFIX
     
     return PlainTextResponse(content=twiml, media_type="application/xml")
 
 
 @router.post("/voice/status")
 async def recording_status(request: Request):
-    form_data = await request.form()
+    form_data = await fast_form(request)
     status = form_data.get("RecordingStatus", "")
-    print(f"📊 ESTADO GRABACIÓN: {status}")
-    return {"status": "ok"}
+    logger.info("voice_recording_status", status=status)
+    return Response(content=_STATUS_OK, media_type="application/json")
 
 
 def _hangup_response(message: str) -> PlainTextResponse:
-    twiml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<Response>
-    <Say language="es-MX" voice="Polly.Mia">{message}</Say>
-    <Hangup/>
-</Response>"""
+    twiml = _HANGUP_PREFIX + escape(message).encode("utf-8") + _HANGUP_SUFFIX
     return PlainTextResponse(content=twiml, media_type="application/xml")
\ No newline at end of file
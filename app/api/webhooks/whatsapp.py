@@ -5,15 +5,22 @@ Recibe mensajes de Twilio y los normaliza para procesamiento.
 """
 
 from fastapi import APIRouter, Request, BackgroundTasks, HTTPException
-from datetime import datetime
 import structlog
 
+from app.core.config import settings
+from app.core.http import TWILIO_HTTP
+from app.core.queue import get_queue
 from app.schemas.message import NormalizedMessage, WebhookResponse
 from app.services.orchestrator import process_message
+from app.utils.forms import fast_form
 
 router = APIRouter()
 logger = structlog.get_logger()
 
+# Remitente y endpoint de Twilio: fijos durante la vida del proceso
+_TWILIO_FROM = f"whatsapp:{settings.twilio_whatsapp_number}"
+_TWILIO_MESSAGES_PATH = f"/2010-04-01/Accounts/{settings.twilio_account_sid}/Messages.json"
+
 
 @router.post("/whatsapp", response_model=WebhookResponse)
 async def whatsapp_webhook(
@@ -24,7 +31,7 @@ async def whatsapp_webhook(
     Recibe mensajes de Twilio WhatsApp.
     """
     try:
-        form_data = await request.form()
+        form_data = await fast_form(request)
         
         # From = número del usuario que envía
         # To = número del sandbox de Twilio
@@ -50,7 +57,6 @@ async def whatsapp_webhook(
             user_id=from_number,
             channel="whatsapp",
             message=body,
-            timestamp=datetime.utcnow(),
             metadata={
                 "twilio_sid": message_sid,
                 "to_number": to_number,
@@ -59,11 +65,16 @@ async def whatsapp_webhook(
         )
         
         # from_number = usuario (a quien responder)
-        background_tasks.add_task(
-            process_and_respond_whatsapp,
-            normalized,
-            from_number
-        )
+        # Con Redis se encola para el worker arq; si no, en el mismo proceso
+        queue = await get_queue()
+        if queue is not None:
+            await queue.enqueue_job("process_whatsapp_job", normalized.model_dump(), from_number)
+        else:
+            background_tasks.add_task(
+                process_and_respond_whatsapp,
+                normalized,
+                from_number
+            )
         
         return WebhookResponse(status="ok", message_id=message_sid)
         
@@ -101,24 +112,22 @@ async def send_whatsapp_message(to_number: str, message: str):
     to_number: número del usuario destinatario
     message: texto a enviar
     """
-    from app.core.config import settings
-    
     if not settings.twilio_account_sid or settings.twilio_account_sid == "tu-account-sid":
         logger.warning("twilio_not_configured", message="Twilio no está configurado")
         return
     
     try:
-        from twilio.rest import Client
-        
-        client = Client(settings.twilio_account_sid, settings.twilio_auth_token)
-        
-        # from_ = número del sandbox de Twilio (configurado en settings)
-        # to = número del usuario
-        client.messages.create(
-            body=message,
-            from_=f"whatsapp:{settings.twilio_whatsapp_number}",
-            to=f"whatsapp:{to_number}"
+        # From = número del sandbox de Twilio (configurado en settings)
+        # To = número del usuario
+        response = await TWILIO_HTTP.post(
+            _TWILIO_MESSAGES_PATH,
+            data={
+                "Body": message,
+                "From": _TWILIO_FROM,
+                "To": f"whatsapp:{to_number}"
+            }
         )
+        response.raise_for_status()
         
         logger.info("twilio_message_sent", to=to_number)
         
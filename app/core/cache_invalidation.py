@@ -0,0 +1,95 @@
+"""
+Invalidación de caches en memoria entre procesos.
+
+Los caches por proceso (respuestas del LLM, contexto RAG) viven en cada
+worker web y en el worker de arq. Al cambiar los documentos de una empresa,
+invalidate_company_caches limpia los de este proceso y publica el id de la
+empresa en Redis; run_invalidation_listener (una tarea por proceso) recibe
+el aviso y limpia los demás. Sin REDIS_URL solo hay un proceso y basta con
+la limpieza local.
+
+Si un proceso pierde la suscripción se pierden los avisos de ese lapso:
+el TTL de cada cache acota cuánto puede servir datos viejos.
+"""
+
+from contextlib import suppress
+from typing import Callable, List, Optional
+import asyncio
+import uuid
+
+import orjson
+import structlog
+
+from app.core.queue import get_cache_redis, REDIS_RETRY_BACKOFF
+
+logger = structlog.get_logger()
+
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+# Identifica a este proceso para no repetir su propia limpieza
+_ORIGIN = uuid.uuid4().hex
+
+_handlers: List[Callable[[Optional[str]], None]] = []
+
+
+def register_invalidation_handler(handler: Callable[[Optional[str]], None]):
+    """Registra una función que limpia un cache en memoria para una empresa."""
+    _handlers.append(handler)
+
+
+def _run_handlers(company_id: Optional[str]):
+    for handler in _handlers:
+        try:
+            handler(company_id)
+        except Exception as e:
+            logger.error("cache_invalidation_handler_error", handler=handler.__qualname__, error=str(e))
+
+
+async def invalidate_company_caches(company_id: Optional[str]):
+    """
+    Invalida los caches de una empresa en este proceso y avisa a los demás.
+    Si Redis no responde, solo se limpia este proceso.
+    """
+    _run_handlers(company_id)
+    
+    redis = await get_cache_redis()
+    if redis is None:
+        return
+    
+    try:
+        await redis.publish(
+            INVALIDATION_CHANNEL,
+            orjson.dumps({"company_id": company_id, "origin": _ORIGIN})
+        )
+    except Exception as e:
+        logger.warning("cache_invalidation_publish_error", company_id=company_id, error=str(e))
+
+
+async def run_invalidation_listener():
+    """
+    Escucha los avisos de invalidación de otros procesos.
+    Corre hasta ser cancelada; si Redis se cae, reintenta la suscripción.
+    """
+    while True:
+        redis = await get_cache_redis()
+        if redis is None:
+            await asyncio.sleep(REDIS_RETRY_BACKOFF)
+            continue
+        
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                payload = orjson.loads(message["data"])
+                if payload.get("origin") != _ORIGIN:
+                    _run_handlers(payload.get("company_id"))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("cache_invalidation_listener_error", error=str(e), retry_in=REDIS_RETRY_BACKOFF)
+            await asyncio.sleep(REDIS_RETRY_BACKOFF)
+        finally:
+            with suppress(Exception):
+                await pubsub.reset()
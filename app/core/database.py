@@ -2,22 +2,31 @@
 Configuración de la base de datos PostgreSQL con SQLAlchemy async.
 """
 
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy.pool import NullPool
+import structlog
 
 from app.core.config import settings
 
+logger = structlog.get_logger()
+
 
 # Convertir URL de Railway a formato asyncpg
 database_url = settings.database_url
 if database_url.startswith("postgresql://"):
     database_url = database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
 
+# Pool de conexiones: evita un handshake TCP+auth con Postgres por request
 engine = create_async_engine(
     database_url,
     echo=settings.debug,
-    poolclass=NullPool,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    # Cache de SQL compilado más amplio que el de defecto (500)
+    query_cache_size=1200,
 )
 
 # Session factory
@@ -57,10 +66,134 @@ async def init_db():
     """
     async with engine.begin() as conn:
         # Importar todos los modelos para que SQLAlchemy los registre
-        from app.models import Company, User, Conversation, Message, CompanyConfig, Feedback  # noqa
+        from app.models import Company, User, Conversation, Message, CompanyConfig, Feedback, DailyMetrics  # noqa
         
         # Crear tablas siempre
         await conn.run_sync(Base.metadata.create_all)
+        
+        await _migrate_api_key_hash(conn)
+        await _migrate_timestamps(conn)
+    
+    await _create_indexes_concurrently()
+
+
+# Índices agregados a los modelos después de creadas las tablas: create_all
+# solo los crea en tablas nuevas. (nombre, definición); deben coincidir con
+# los Index de __table_args__
+_CONCURRENT_INDEXES = (
+    ("ix_users_company_phone", "ON users (company_id, phone) WHERE phone IS NOT NULL"),
+    (
+        "ix_conversations_user_channel_active",
+        "ON conversations (user_id, channel, last_message_at DESC) WHERE status = 'active'"
+    ),
+    ("ix_messages_conversation_created", "ON messages (conversation_id, created_at DESC) INCLUDE (role)"),
+)
+
+# Índices que ya no están en los modelos: solo encarecían las escrituras
+_DROPPED_INDEXES = ("ix_messages_content_trgm",)
+
+
+async def _create_indexes_concurrently():
+    """
+    Crea en bases existentes los índices de _CONCURRENT_INDEXES sin bloquear
+    las escrituras (CREATE INDEX CONCURRENTLY no puede correr dentro de una
+    transacción: usa una conexión en autocommit). Un build interrumpido deja
+    el índice INVALID, que IF NOT EXISTS no reconstruiría: se borra primero.
+    También borra los de _DROPPED_INDEXES. Un fallo no aborta el arranque;
+    se reintenta en el siguiente.
+    """
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        invalid = set((await conn.execute(text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE NOT i.indisvalid"
+        ))).scalars())
+        
+        for name, definition in _CONCURRENT_INDEXES:
+            try:
+                if name in invalid:
+                    await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+                await conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}"))
+            except Exception as e:
+                logger.warning("index_creation_failed", index=name, error=str(e))
+        
+        for name in _DROPPED_INDEXES:
+            try:
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            except Exception as e:
+                logger.warning("index_drop_failed", index=name, error=str(e))
+
+
+# Columnas de fecha de los modelos: (tabla, columna, con DEFAULT now())
+_TIMESTAMP_COLUMNS = (
+    ("companies", "created_at", True),
+    ("companies", "updated_at", True),
+    ("company_configs", "created_at", True),
+    ("company_configs", "updated_at", True),
+    ("conversations", "started_at", True),
+    ("conversations", "ended_at", False),
+    ("conversations", "last_message_at", True),
+    ("messages", "created_at", True),
+    ("feedback", "created_at", True),
+    ("users", "created_at", True),
+    ("users", "updated_at", True),
+    ("users", "last_interaction", False),
+)
+
+
+async def _migrate_timestamps(conn):
+    """
+    Migración de las columnas de fecha para bases creadas cuando eran
+    timestamp sin zona y con el default en Python: las pasa a timestamptz
+    (los valores guardados eran UTC) y agrega DEFAULT now(), del que
+    dependen los INSERT (los modelos usan server_default). Idempotente:
+    solo altera lo que todavía no está migrado.
+    """
+    rows = (await conn.execute(text(
+        "SELECT table_name, column_name, data_type, column_default "
+        "FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND data_type LIKE 'timestamp%'"
+    ))).all()
+    current = {(row.table_name, row.column_name): row for row in rows}
+    
+    for table, column, has_default in _TIMESTAMP_COLUMNS:
+        row = current.get((table, column))
+        if row is None:
+            continue
+        if row.data_type == "timestamp without time zone":
+            await conn.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN {column} "
+                f"TYPE timestamptz USING {column} AT TIME ZONE 'UTC'"
+            ))
+        if has_default and row.column_default is None:
+            await conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT now()"))
+
+
+async def _migrate_api_key_hash(conn):
+    """
+    Migración de companies.api_key_hash para bases creadas antes de la
+    columna (create_all no altera tablas existentes): agrega la columna,
+    completa el hash de las empresas existentes, crea su índice único y
+    quita el índice único de la API key en texto plano. Idempotente.
+    """
+    from app.models.company import hash_api_key
+    
+    await conn.execute(text("ALTER TABLE companies ADD COLUMN IF NOT EXISTS api_key_hash BYTEA"))
+    
+    rows = (await conn.execute(
+        text("SELECT id, api_key FROM companies WHERE api_key_hash IS NULL")
+    )).all()
+    if rows:
+        await conn.execute(
+            text("UPDATE companies SET api_key_hash = :key_hash WHERE id = :id"),
+            [{"id": row.id, "key_hash": hash_api_key(row.api_key)} for row in rows]
+        )
+    
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS companies_api_key_hash_key ON companies (api_key_hash)"
+    ))
+    await conn.execute(text("ALTER TABLE companies ALTER COLUMN api_key_hash SET NOT NULL"))
+    await conn.execute(text("ALTER TABLE companies DROP CONSTRAINT IF EXISTS companies_api_key_key"))
 
 
 async def close_db():
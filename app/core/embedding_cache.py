@@ -0,0 +1,85 @@
+"""
+Cache de embeddings.
+
+Dos niveles, ambos con los vectores en float16 (~3KB a 1536 dimensiones):
+- LRU en memoria del proceso.
+- Redis (si REDIS_URL está configurado), compartido entre workers: una
+  consulta que embebió un worker no vuelve a pagar OpenAI en otro.
+
+La llave es el hash de (modelo, dimensiones, texto).
+"""
+
+from typing import List, Optional
+import hashlib
+
+from cachetools import LRUCache
+import numpy as np
+import structlog
+
+from app.core.config import settings
+from app.core.queue import get_cache_redis
+
+logger = structlog.get_logger()
+
+# Vectores en memoria por proceso y segundos de vida en Redis
+EMBEDDING_CACHE_SIZE = 4096
+EMBEDDING_REDIS_TTL = 30 * 24 * 3600
+
+_embedding_cache: LRUCache = LRUCache(maxsize=EMBEDDING_CACHE_SIZE)
+
+
+def _cache_key(text: str) -> str:
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    return f"emb:{settings.openai_embedding_model}:{settings.openai_embedding_dimensions}:{digest}"
+
+
+async def get_cached_embedding(text: str) -> Optional[np.ndarray]:
+    """Retorna el embedding cacheado (float32) o None."""
+    key = _cache_key(text)
+    cached = _embedding_cache.get(key)
+    if cached is not None:
+        return cached.astype(np.float32)
+    
+    redis = await get_cache_redis()
+    if redis is None:
+        return None
+    
+    try:
+        data = await redis.get(key)
+    except Exception as e:
+        logger.warning("embedding_cache_error", error=str(e))
+        return None
+    
+    if data is None:
+        return None
+    
+    cached = np.frombuffer(data, dtype=np.float16)
+    _embedding_cache[key] = cached
+    return cached.astype(np.float32)
+
+
+async def set_cached_embeddings(texts: List[str], embeddings: list):
+    """Guarda los embeddings en memoria y en Redis (un solo pipeline)."""
+    items = []
+    for text, embedding in zip(texts, embeddings):
+        key = _cache_key(text)
+        vector = np.asarray(embedding, dtype=np.float16)
+        _embedding_cache[key] = vector
+        items.append((key, vector.tobytes()))
+    
+    redis = await get_cache_redis()
+    if redis is None or not items:
+        return
+    
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for key, data in items:
+                pipe.setex(key, EMBEDDING_REDIS_TTL, data)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning("embedding_cache_error", error=str(e))
+
+
+async def set_cached_embedding(text: str, embedding):
+    """Guarda un embedding en memoria y en Redis."""
+    await set_cached_embeddings([text], [embedding])
@@ -0,0 +1,82 @@
+"""
+Ventana de historial de conversación en Redis.
+
+Los últimos HISTORY_WINDOW mensajes de cada conversación se guardan como
+una lista (el más reciente primero), así cada turno lee el historial con
+un LRANGE en vez de consultar Postgres. Si REDIS_URL no está configurado
+o Redis falla, se usa la base de datos.
+"""
+
+from typing import Optional
+import orjson
+import structlog
+
+from app.core.queue import get_cache_redis
+
+logger = structlog.get_logger()
+
+# Mensajes guardados por conversación y segundos de vida de la lista
+HISTORY_WINDOW = 20
+HISTORY_TTL = 3600
+
+
+def _history_key(conversation_id: str) -> str:
+    return f"hist:{conversation_id}"
+
+
+async def get_cached_history(conversation_id: str, limit: int) -> Optional[list]:
+    """
+    Retorna los últimos `limit` mensajes en orden cronológico,
+    o None si la conversación no está en Redis.
+    """
+    redis = await get_cache_redis()
+    if redis is None:
+        return None
+    
+    try:
+        items = await redis.lrange(_history_key(conversation_id), 0, limit - 1)
+    except Exception as e:
+        logger.warning("history_cache_error", error=str(e))
+        return None
+    
+    if not items:
+        return None
+    return [orjson.loads(item) for item in reversed(items)]
+
+
+async def warm_history(conversation_id: str, history: list):
+    """Carga en Redis el historial leído de la base de datos (orden cronológico)."""
+    redis = await get_cache_redis()
+    if redis is None or not history:
+        return
+    
+    key = _history_key(conversation_id)
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.lpush(key, *(orjson.dumps(m) for m in history[-HISTORY_WINDOW:]))
+            pipe.expire(key, HISTORY_TTL)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning("history_cache_error", error=str(e))
+
+
+async def append_history(conversation_id: str, role: str, content: str):
+    """
+    Agrega un mensaje a la ventana y la recorta a HISTORY_WINDOW.
+    Solo si la lista ya existe (LPUSHX): una ventana parcial no debe
+    ocultar mensajes que solo están en la base de datos.
+    """
+    redis = await get_cache_redis()
+    if redis is None:
+        return
+    
+    key = _history_key(conversation_id)
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.lpushx(key, orjson.dumps({"role": role, "content": content}))
+            pipe.ltrim(key, 0, HISTORY_WINDOW - 1)
+            pipe.expire(key, HISTORY_TTL)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning("history_cache_error", error=str(e))
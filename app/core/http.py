@@ -0,0 +1,32 @@
+"""
+Clientes HTTP compartidos.
+
+Un solo AsyncClient por servicio externo mantiene las conexiones vivas
+(keep-alive) y evita un handshake TCP+TLS por cada request.
+"""
+
+import httpx
+
+from app.core.config import settings
+
+
+# Cliente para la API REST de Twilio
+TWILIO_HTTP = httpx.AsyncClient(
+    base_url="https://api.twilio.com",
+    auth=(settings.twilio_account_sid, settings.twilio_auth_token),
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+
+# Cliente para la API de ElevenLabs (text-to-speech)
+ELEVENLABS_HTTP = httpx.AsyncClient(
+    base_url="https://api.elevenlabs.io",
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+)
+
+
+async def close_http_clients():
+    """Cierra los clientes HTTP compartidos."""
+    await TWILIO_HTTP.aclose()
+    await ELEVENLABS_HTTP.aclose()
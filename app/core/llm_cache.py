@@ -0,0 +1,188 @@
+"""
+Cache en proceso de respuestas del LLM.
+
+Los mensajes cortos y repetidos ("hola", "precios", "horarios") dominan
+el tráfico de voz y WhatsApp. Guardar la respuesta por empresa y mensaje
+normalizado evita la llamada a OpenAI en los aciertos.
+
+Dos niveles:
+- L1: coincidencia exacta del mensaje normalizado.
+- L2: similitud coseno del embedding del mensaje contra las preguntas
+  ya respondidas de la misma empresa ("cuánto cuesta" ~ "cuál es el precio").
+"""
+
+from typing import Any, Dict, Optional, Tuple
+import hashlib
+import time
+
+from cachetools import TTLCache
+import numpy as np
+
+from app.core.cache_invalidation import register_invalidation_handler
+from app.schemas.message import AgentResponse
+
+
+# Máximo de entradas y segundos de vida de cada respuesta
+LLM_CACHE_MAXSIZE = 10_000
+LLM_CACHE_TTL = 1800
+
+# Similitud mínima para un acierto semántico y preguntas guardadas por empresa
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_PER_COMPANY = 256
+# Filas iniciales de la matriz de cada empresa (se duplica hasta max_per_company)
+SEMANTIC_CACHE_INITIAL_ROWS = 16
+
+_cache: TTLCache = TTLCache(maxsize=LLM_CACHE_MAXSIZE, ttl=LLM_CACHE_TTL)
+
+
+def cache_key(company_id: Optional[str], user_message: str, variant: str = "") -> Tuple[Optional[str], str]:
+    """
+    Genera la llave del cache: (empresa, hash de variante + mensaje normalizado).
+    variant identifica el prompt con el que se generó la respuesta (nombre
+    de la empresa, palabras de escalación): canales con prompts distintos no
+    comparten respuestas. La empresa queda en claro para poder invalidar sus entradas.
+    """
+    normalized = user_message.strip().lower()
+    raw = f"{variant}\0{normalized}"
+    return company_id, hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+
+def get_cached_response(company_id: Optional[str], user_message: str, variant: str = "") -> Optional[AgentResponse]:
+    """Retorna la respuesta cacheada o None si no existe o expiró."""
+    return _cache.get(cache_key(company_id, user_message, variant))
+
+
+def set_cached_response(company_id: Optional[str], user_message: str, response: AgentResponse, variant: str = ""):
+    """
+    Guarda una respuesta en el cache.
+    Las respuestas de error (confidence 0) no se cachean.
+    """
+    if not response.confidence:
+        return
+    _cache[cache_key(company_id, user_message, variant)] = response
+
+
+class _CompanyEntries:
+    """
+    Buffer circular de una empresa: matriz de embeddings normalizados,
+    vencimientos y valores. Crece por duplicación hasta su capacidad
+    máxima y luego cada inserción reemplaza la fila más vieja en su lugar.
+    """
+    
+    __slots__ = ("vectors", "expires", "values", "size", "next")
+    
+    def __init__(self, dimension: int, rows: int):
+        self.vectors = np.zeros((rows, dimension), dtype=np.float32)
+        self.expires = np.full(rows, -np.inf)
+        self.values: list = [None] * rows
+        self.size = 0
+        self.next = 0
+    
+    def grow(self, rows: int):
+        vectors = np.zeros((rows, self.vectors.shape[1]), dtype=np.float32)
+        vectors[:self.size] = self.vectors[:self.size]
+        expires = np.full(rows, -np.inf)
+        expires[:self.size] = self.expires[:self.size]
+        self.vectors, self.expires = vectors, expires
+        self.values.extend([None] * (rows - len(self.values)))
+
+
+class SemanticCache:
+    """
+    Cache L2 por similitud de embeddings, separado por empresa.
+    Guarda respuestas del LLM; rag_service lo reutiliza para contextos RAG.
+    
+    Cada empresa (y variante de prompt, ver cache_key) guarda una matriz de
+    embeddings normalizados; la búsqueda es
+    un solo producto matriz-vector. Las entradas expiran a los `ttl` segundos
+    y se conservan como máximo `max_per_company` en un buffer circular: una
+    inserción escribe una fila sin copiar la matriz (se reemplaza la más vieja).
+    """
+    
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_per_company: int = SEMANTIC_CACHE_PER_COMPANY,
+        ttl: int = LLM_CACHE_TTL
+    ):
+        self.threshold = threshold
+        self.max_per_company = max_per_company
+        self.ttl = ttl
+        self._entries: Dict[Tuple[Optional[str], str], _CompanyEntries] = {}
+    
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+    
+    def get(self, company_id: Optional[str], embedding, variant: str = "") -> Optional[Any]:
+        """Retorna el valor vigente más parecido si supera el umbral."""
+        entries = self._entries.get((company_id, variant))
+        if entries is None or not entries.size:
+            return None
+        
+        size = entries.size
+        scores = entries.vectors[:size] @ self._normalize(embedding)
+        scores[entries.expires[:size] < time.monotonic()] = -np.inf
+        best = int(scores.argmax())
+        if scores[best] < self.threshold:
+            return None
+        return entries.values[best]
+    
+    def set(self, company_id: Optional[str], embedding, response: Any, variant: str = ""):
+        """Agrega una pregunta respondida en la siguiente fila del buffer."""
+        vector = self._normalize(embedding)
+        key = (company_id, variant)
+        entries = self._entries.get(key)
+        if entries is None:
+            rows = min(SEMANTIC_CACHE_INITIAL_ROWS, self.max_per_company)
+            entries = self._entries[key] = _CompanyEntries(vector.shape[0], rows)
+        
+        slot = entries.next
+        if slot >= len(entries.values):
+            entries.grow(min(2 * len(entries.values), self.max_per_company))
+        
+        entries.vectors[slot] = vector
+        entries.expires[slot] = time.monotonic() + self.ttl
+        entries.values[slot] = response
+        entries.size = max(entries.size, slot + 1)
+        entries.next = (slot + 1) % self.max_per_company
+    
+    def invalidate(self, company_id: Optional[str]):
+        for key in [k for k in self._entries if k[0] == company_id]:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        self._entries.clear()
+
+
+semantic_cache = SemanticCache()
+
+
+def get_semantic_response(company_id: Optional[str], embedding, variant: str = "") -> Optional[AgentResponse]:
+    """Retorna la respuesta de una pregunta similar (L2) o None."""
+    return semantic_cache.get(company_id, embedding, variant)
+
+
+def set_semantic_response(company_id: Optional[str], embedding, response: AgentResponse, variant: str = ""):
+    """Guarda una respuesta en el cache semántico (no cachea errores)."""
+    if not response.confidence:
+        return
+    semantic_cache.set(company_id, embedding, response, variant)
+
+
+def invalidate_company(company_id: str):
+    """Descarta las respuestas cacheadas de una empresa (p. ej. al cambiar sus documentos)."""
+    for key in [k for k in _cache.keys() if k[0] == company_id]:
+        _cache.pop(key, None)
+    semantic_cache.invalidate(company_id)
+
+
+# Los demás procesos (workers web, worker de arq) se enteran por Redis
+register_invalidation_handler(invalidate_company)
+
+
+def clear_cache():
+    """Vacía ambos niveles del cache (útil al actualizar la base de conocimiento)."""
+    _cache.clear()
+    semantic_cache.clear()
@@ -0,0 +1,103 @@
+"""
+Configuración de logging estructurado.
+
+Los logs de structlog pasan por el logging de la stdlib hacia una cola:
+en el request solo se agrega el timestamp y se encola el evento. El
+renderizado (JSON con orjson o consola) y la escritura a stdout ocurren
+en el hilo de un QueueListener.
+"""
+
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+import logging
+import queue
+import sys
+
+import orjson
+import structlog
+
+from app.core.config import settings
+
+
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_listener: Optional[QueueListener] = None
+_listener_running = False
+
+
+def _orjson_dumps(obj, **kwargs) -> str:
+    """Serializador de structlog con orjson (el logger stdlib espera str)."""
+    return orjson.dumps(obj, default=kwargs.get("default")).decode()
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler que encola el record sin formatearlo.
+    El QueueHandler estándar formatea en prepare(), es decir en el hilo
+    que loguea; aquí el formateo queda para el listener.
+    """
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure_logging():
+    """Configura structlog y el handler de cola en el logger raíz."""
+    timestamper = structlog.processors.TimeStamper(fmt="iso")
+    
+    structlog.configure(
+        processors=[
+            structlog.stdlib.filter_by_level,
+            structlog.stdlib.add_logger_name,
+            structlog.stdlib.add_log_level,
+            timestamper,
+            structlog.stdlib.ProcessorFormatter.wrap_for_formatter,
+        ],
+        wrapper_class=structlog.stdlib.BoundLogger,
+        context_class=dict,
+        logger_factory=structlog.stdlib.LoggerFactory(),
+        cache_logger_on_first_use=True,
+    )
+    
+    # En dev ConsoleRenderer formatea el traceback; en prod lo hace format_exc_info
+    if settings.is_production:
+        renderers = (
+            structlog.processors.format_exc_info,
+            structlog.processors.JSONRenderer(serializer=_orjson_dumps),
+        )
+    else:
+        renderers = (structlog.dev.ConsoleRenderer(),)
+    
+    formatter = structlog.stdlib.ProcessorFormatter(
+        foreign_pre_chain=[structlog.stdlib.add_log_level, timestamper],
+        processors=[
+            structlog.stdlib.ProcessorFormatter.remove_processors_meta,
+            structlog.processors.UnicodeDecoder(),
+            *renderers,
+        ],
+    )
+    
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setFormatter(formatter)
+    
+    global _listener
+    _listener = QueueListener(_log_queue, stdout_handler, respect_handler_level=True)
+    
+    root = logging.getLogger()
+    root.handlers = [_DeferredQueueHandler(_log_queue)]
+    root.setLevel(settings.log_level.upper())
+
+
+def start_log_listener():
+    """Arranca el hilo que renderiza y escribe los logs encolados."""
+    global _listener_running
+    if _listener is not None and not _listener_running:
+        _listener.start()
+        _listener_running = True
+
+
+def stop_log_listener():
+    """Vacía la cola y detiene el hilo del listener."""
+    global _listener_running
+    if _listener is not None and _listener_running:
+        _listener.stop()
+        _listener_running = False
@@ -0,0 +1,29 @@
+"""
+Cliente de OpenAI compartido.
+
+Chat, embeddings, Whisper y la Batch API usan el mismo pool de conexiones
+a api.openai.com: requests concurrentes de distintos servicios reutilizan
+los mismos sockets en vez de abrir un pool (y handshakes TLS) cada uno.
+"""
+
+import httpx
+import openai
+
+from app.core.config import settings
+
+
+# Pool de conexiones amplio y sin reintentos propios del SDK (los maneja
+# cada servicio: backoff en ai_service, with_options en los demás)
+client = openai.AsyncOpenAI(
+    api_key=settings.openai_api_key,
+    max_retries=0,
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        timeout=httpx.Timeout(60.0, connect=5.0)
+    )
+)
+
+
+async def close_openai_client():
+    """Cierra el pool de conexiones a OpenAI."""
+    await client.close()
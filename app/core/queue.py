@@ -0,0 +1,68 @@
+"""
+Cola de trabajos en Redis (arq).
+
+Permite sacar el procesamiento de mensajes (LLM, varios segundos) del
+worker web. Si REDIS_URL no está configurado, la cola no se usa.
+"""
+
+from typing import Optional
+import time
+
+from arq import create_pool
+from arq.connections import ArqRedis, RedisSettings
+import structlog
+
+from app.core.config import settings
+
+logger = structlog.get_logger()
+
+# Segundos sin volver a intentar la conexión después de un fallo (caches)
+REDIS_RETRY_BACKOFF = 30.0
+
+_pool: Optional[ArqRedis] = None
+_unavailable_until = 0.0
+
+
+def get_redis_settings() -> RedisSettings:
+    """Configuración de Redis para el pool y el worker."""
+    return RedisSettings.from_dsn(settings.redis_url)
+
+
+async def get_queue() -> Optional[ArqRedis]:
+    """
+    Retorna el pool de arq, creándolo en el primer uso.
+    Retorna None si Redis no está configurado.
+    """
+    global _pool
+    if not settings.redis_url:
+        return None
+    if _pool is None:
+        _pool = await create_pool(get_redis_settings())
+    return _pool
+
+
+async def get_cache_redis() -> Optional[ArqRedis]:
+    """
+    Pool de Redis para los caches: como get_queue, pero nunca lanza.
+    Si la conexión falla (create_pool reintenta unos segundos antes de
+    rendirse) retorna None y durante REDIS_RETRY_BACKOFF segundos no se
+    vuelve a intentar: los caches caen a su respaldo sin pagar la espera
+    en cada request.
+    """
+    global _unavailable_until
+    if time.monotonic() < _unavailable_until:
+        return None
+    try:
+        return await get_queue()
+    except Exception as e:
+        _unavailable_until = time.monotonic() + REDIS_RETRY_BACKOFF
+        logger.warning("redis_unavailable", error=str(e), retry_in=REDIS_RETRY_BACKOFF)
+        return None
+
+
+async def close_queue():
+    """Cierra la conexión con Redis."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
\ No newline at end of file
@@ -6,10 +6,15 @@ Maneja API keys y validación de empresas.
 from fastapi import HTTPException, Security, Depends, status
 from fastapi.security import APIKeyHeader
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, lambda_stmt, bindparam
 from typing import Optional
+import hmac
+import secrets
+
+from cachetools import TTLCache
 
 from app.core.database import get_db
+from app.models.company import Company, hash_api_key
 
 
 # Header para API Key
@@ -20,6 +25,16 @@ api_key_header = APIKeyHeader(
 )
 
 
+# Cache de API key (hash) -> CompanyContext para no consultar Postgres en cada request
+COMPANY_CACHE_TTL = 60
+_company_cache: TTLCache = TTLCache(maxsize=1024, ttl=COMPANY_CACHE_TTL)
+
+# Consulta precompilada: el SQL se cachea por el code object de la lambda
+_COMPANY_BY_KEY_HASH = lambda_stmt(
+    lambda: select(Company).where(Company.api_key_hash == bindparam("key_hash"))
+)
+
+
 class CompanyContext:
     """
     Contexto de la empresa autenticada.
@@ -53,12 +68,7 @@ async def get_company_from_api_key(
             headers={"WWW-Authenticate": "ApiKey"},
         )
     
-    # Buscar empresa por API key
-    from app.models.company import Company
-    
-    query = select(Company).where(Company.api_key == api_key)
-    result = await db.execute(query)
-    company = result.scalar_one_or_none()
+    company = await _load_company(api_key, db)
     
     if not company:
         raise HTTPException(
@@ -72,11 +82,43 @@ async def get_company_from_api_key(
             detail="Empresa desactivada. Contactar soporte."
         )
     
-    return CompanyContext(
+    return company
+
+
+async def _load_company(api_key: str, db: AsyncSession) -> Optional[CompanyContext]:
+    """
+    Busca la empresa de una API key, con cache en proceso de COMPANY_CACHE_TTL segundos.
+    """
+    key_hash = hash_api_key(api_key)
+    cached = _company_cache.get(key_hash)
+    if cached is not None:
+        return cached
+    
+    # Buscar empresa por el hash de la API key
+    result = await db.execute(_COMPANY_BY_KEY_HASH, {"key_hash": key_hash})
+    company = result.scalar_one_or_none()
+    
+    if not company or not hmac.compare_digest(company.api_key, api_key):
+        return None
+    
+    context = CompanyContext(
         company_id=company.id,
         name=company.name,
         is_active=company.is_active
     )
+    _company_cache[key_hash] = context
+    return context
+
+
+def invalidate_company_cache(api_key: Optional[str] = None):
+    """
+    Invalida el cache de empresas (una API key o todo).
+    Llamar al desactivar una empresa o rotar su API key.
+    """
+    if api_key is None:
+        _company_cache.clear()
+    else:
+        _company_cache.pop(hash_api_key(api_key), None)
 
 
 async def get_optional_company(
@@ -99,7 +141,6 @@ async def get_optional_company(
 def generate_api_key() -> str:
     """
     Genera una nueva API key única.
-    Formato: aie_xxxxxxxxxxxxxxxxxxxxxxxxxxxx
+    Formato: aie_xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx (192 bits en base64 URL-safe)
     """
-    import secrets
-    return f"aie_{secrets.token_hex(24)}"
+    return f"aie_{secrets.token_urlsafe(24)}"
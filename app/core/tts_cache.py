@@ -0,0 +1,79 @@
+"""
+Cache de audio de text-to-speech.
+
+Los agentes repiten frases fijas ("Gracias por contactarnos", menús), así
+que el MP3 de ElevenLabs se guarda por hash de (voz, modelo, ajustes,
+formato, texto). Primero en memoria del proceso y, si REDIS_URL está
+configurado, en Redis para compartirlo entre workers.
+"""
+
+from typing import Optional
+import hashlib
+
+from cachetools import LRUCache
+import orjson
+import structlog
+
+from app.core.queue import get_cache_redis
+
+logger = structlog.get_logger()
+
+# Audios en memoria por proceso (~50KB cada uno) y segundos de vida en Redis
+TTS_CACHE_MAXSIZE = 256
+TTS_CACHE_TTL = 7 * 24 * 3600
+
+_audio_cache: LRUCache = LRUCache(maxsize=TTS_CACHE_MAXSIZE)
+
+# data URL (base64) ya armado por audio, solo en memoria: se deriva del MP3
+_data_url_cache: LRUCache = LRUCache(maxsize=TTS_CACHE_MAXSIZE)
+
+
+def tts_cache_key(voice_id: str, model_id: str, voice_settings: dict, output_format: str, text: str) -> str:
+    """Hash de todo lo que determina el audio generado."""
+    settings_json = orjson.dumps(voice_settings, option=orjson.OPT_SORT_KEYS).decode()
+    raw = f"{voice_id}|{model_id}|{settings_json}|{output_format}|{text}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+async def get_cached_audio(key: str) -> Optional[bytes]:
+    """Retorna el MP3 cacheado o None."""
+    audio = _audio_cache.get(key)
+    if audio is not None:
+        return audio
+    
+    redis = await get_cache_redis()
+    if redis is None:
+        return None
+    
+    try:
+        audio = await redis.get(f"tts:{key}")
+    except Exception as e:
+        logger.warning("tts_cache_error", error=str(e))
+        return None
+    
+    if audio is not None:
+        _audio_cache[key] = audio
+    return audio
+
+
+async def set_cached_audio(key: str, audio: bytes):
+    """Guarda el MP3 en memoria y, si hay Redis, con TTS_CACHE_TTL de vida."""
+    _audio_cache[key] = audio
+    
+    redis = await get_cache_redis()
+    if redis is None:
+        return
+    
+    try:
+        await redis.setex(f"tts:{key}", TTS_CACHE_TTL, audio)
+    except Exception as e:
+        logger.warning("tts_cache_error", error=str(e))
+
+
+def get_cached_data_url(key: str) -> Optional[str]:
+    """Retorna el data URL cacheado del audio o None."""
+    return _data_url_cache.get(key)
+
+
+def set_cached_data_url(key: str, data_url: str):
+    _data_url_cache[key] = data_url
@@ -5,36 +5,65 @@ AI Engine - Motor de IA Multicanal
 Aplicación principal FastAPI.
 """
 
-from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, status
+from contextlib import asynccontextmanager, suppress
+import asyncio
+from fastapi import APIRouter, FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
+from typing import List
+from qdrant_client import AsyncQdrantClient
+from sqlalchemy import text
 import structlog
 import time
 
 from app.core.config import settings
-from app.core.database import init_db, close_db
-
-
-# Configurar logging estructurado
-structlog.configure(
-    processors=[
-        structlog.stdlib.filter_by_level,
-        structlog.stdlib.add_logger_name,
-        structlog.stdlib.add_log_level,
-        structlog.processors.TimeStamper(fmt="iso"),
-        structlog.processors.StackInfoRenderer(),
-        structlog.processors.format_exc_info,
-        structlog.processors.UnicodeDecoder(),
-        structlog.processors.JSONRenderer() if settings.is_production 
-            else structlog.dev.ConsoleRenderer()
-    ],
-    wrapper_class=structlog.stdlib.BoundLogger,
-    context_class=dict,
-    logger_factory=structlog.stdlib.LoggerFactory(),
-    cache_logger_on_first_use=True,
+from app.core.database import init_db, close_db, engine, async_session_maker
+from app.core.http import TWILIO_HTTP, close_http_clients
+from app.core.openai_client import close_openai_client
+from app.core.logging_setup import configure_logging, start_log_listener, stop_log_listener
+from app.core.cache_invalidation import invalidate_company_caches, run_invalidation_listener
+from app.core.queue import close_queue
+from app.core.security import generate_api_key
+from app.models import Company, CompanyConfig
+from app.services.ai_service import generate_ai_response, stream_ai_response
+from app.services.rag_service import (
+    add_document,
+    add_documents,
+    search_documents,
+    forget_collection,
+    qdrant_client,
+    close_qdrant
 )
+from app.services.voice_service import warmup_speech_to_text
+from app.services.database_service import invalidate_company_config, flush_write_behind
+from app.services.batch_ai_service import (
+    submit_low_rated_review,
+    fetch_batch_results,
+    submit_document_ingest,
+    complete_document_ingest
+)
+from app.services.feedback_service import (
+    run_daily_metrics_loop,
+    save_feedback,
+    get_conversation_metrics,
+    get_lead_funnel,
+    detect_escalation_patterns
+)
+
+
+# Valores de configuración fijos durante la vida del proceso
+IS_DEV = settings.is_development
+IS_PROD = settings.is_production
+APP_NAME = settings.app_name
+CORS_ORIGINS = tuple(settings.cors_origins)
+APP_VERSION = "0.2.0"
+DOCS_URL = "/docs" if IS_DEV else None
+REDOC_URL = "/redoc" if IS_DEV else None
+
+
+# Configurar logging estructurado (renderizado en el hilo del QueueListener)
+configure_logging()
 
 logger = structlog.get_logger()
 
@@ -44,19 +73,67 @@ async def lifespan(app: FastAPI):
     """
     Maneja el ciclo de vida de la aplicación.
     """
+    start_log_listener()
     logger.info("🚀 Iniciando AI Engine", env=settings.app_env)
+    # Fail-fast: si Postgres o Qdrant no responden, la excepción aborta el arranque
     await init_db()
     logger.info("✅ Base de datos conectada")
+    app.state.qdrant = qdrant_client
+    await _check_qdrant(app.state.qdrant)
+    logger.info("✅ Qdrant conectado")
+    await warmup()
+    background_tasks = [asyncio.create_task(_refresh_readiness(app.state.qdrant))]
+    # Sin worker de arq el rollup de métricas corre en el proceso web
+    if not settings.redis_url:
+        background_tasks.append(asyncio.create_task(run_daily_metrics_loop()))
+    else:
+        # Con varios procesos los caches en memoria se invalidan por Redis
+        background_tasks.append(asyncio.create_task(run_invalidation_listener()))
     
     yield
     
     logger.info("🛑 Cerrando AI Engine")
+    for task in background_tasks:
+        task.cancel()
+    with suppress(asyncio.CancelledError):
+        await asyncio.gather(*background_tasks)
+    await flush_write_behind()
     await close_db()
+    await close_http_clients()
+    await close_openai_client()
+    await close_queue()
+    await close_qdrant()
     logger.info("✅ Conexiones cerradas")
+    stop_log_listener()
+
+
+async def warmup():
+    """
+    Abre las conexiones y carga los modelos antes del primer request:
+    TLS con Twilio, una conexión del pool de Postgres y Whisper local.
+    Un fallo solo se registra; no impide el arranque.
+    """
+    async def _warm_twilio():
+        await TWILIO_HTTP.get("/")
+    
+    async def _warm_db():
+        async with engine.connect():
+            pass
+    
+    results = await asyncio.gather(
+        _warm_twilio(),
+        _warm_db(),
+        warmup_speech_to_text(),
+        return_exceptions=True
+    )
+    for name, result in zip(("twilio", "database", "whisper"), results):
+        if isinstance(result, Exception):
+            logger.warning("warmup_failed", target=name, error=str(result))
+    logger.info("🔥 Conexiones precalentadas")
 
 
 app = FastAPI(
-    title=settings.app_name,
+    title=APP_NAME,
     description="""
     ## Motor de IA Multicanal
     
@@ -71,29 +148,37 @@ app = FastAPI(
     - RAG (Retrieval Augmented Generation)
     - Feedback loop para aprendizaje
     """,
-    version="0.2.0",
+    version=APP_VERSION,
     lifespan=lifespan,
-    docs_url="/docs" if settings.is_development else None,
-    redoc_url="/redoc" if settings.is_development else None,
+    default_response_class=ORJSONResponse,
+    docs_url=DOCS_URL,
+    redoc_url=REDOC_URL,
 )
 
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=settings.cors_origins,
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 
+# Rutas de health checks y docs: sin medición ni logging
+_SKIP_PATHS = frozenset({"/", "/health", "/health/ready", "/health/db-pool", "/docs", "/redoc", "/openapi.json"})
+
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    start_time = time.time()
+    if request.url.path in _SKIP_PATHS:
+        return await call_next(request)
+    
+    start_time = time.perf_counter()
     response = await call_next(request)
-    process_time = (time.time() - start_time) * 1000
+    process_time = (time.perf_counter() - start_time) * 1000
     
-    if settings.is_development or process_time > 1000:
+    if IS_DEV or process_time > 1000:
         logger.info(
             "request",
             method=request.method,
@@ -102,25 +187,28 @@ async def log_requests(request: Request, call_next):
             duration_ms=round(process_time, 2)
         )
     
-    response.headers["X-Process-Time"] = str(round(process_time, 2))
+    if IS_DEV:
+        response.headers["X-Process-Time"] = f"{process_time:.2f}"
     return response
 
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
+    # El traceback se formatea en el hilo del QueueListener, no en el request
     logger.error(
         "unhandled_exception",
         path=request.url.path,
         method=request.method,
         error=str(exc),
+        error_type=type(exc).__name__,
         exc_info=True
     )
     
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={
             "detail": "Error interno del servidor",
-            "error": str(exc) if settings.is_development else None
+            "error": str(exc) if IS_DEV else None
         }
     )
 
@@ -129,111 +217,158 @@ async def global_exception_handler(request: Request, exc: Exception):
 # ENDPOINTS BASE
 # ===========================================
 
+_ROOT_BODY = {
+    "name": APP_NAME,
+    "version": APP_VERSION,
+    "status": "running",
+    "docs": DOCS_URL or "disabled"
+}
+
+
 @app.get("/", tags=["Health"])
 async def root():
-    return {
-        "name": settings.app_name,
-        "version": "0.2.0",
-        "status": "running",
-        "docs": "/docs" if settings.is_development else "disabled"
-    }
+    return _ROOT_BODY
+
+
+_HEALTH_BODY = {
+    "status": "healthy",
+    "environment": settings.app_env,
+    "checks": {"api": "ok"}
+}
 
 
 @app.get("/health", tags=["Health"])
 async def health_check():
-    return {
-        "status": "healthy",
-        "environment": settings.app_env,
-        "checks": {"api": "ok"}
-    }
+    return _HEALTH_BODY
+
+
+# Tiempo máximo de cada check de readiness y cada cuánto se refresca (segundos)
+READINESS_TIMEOUT = 2.0
+READINESS_INTERVAL = 5.0
+
+_SELECT_ONE = text("SELECT 1")
+
+# Último estado conocido; el arranque ya validó ambos backends
+_readiness = {
+    "status": "ready",
+    "checks": {"database": "ok", "qdrant": "ok"}
+}
+
+
+async def _check_database():
+    async with engine.connect() as conn:
+        await conn.execute(_SELECT_ONE)
+
+
+async def _check_qdrant(client: AsyncQdrantClient):
+    await client.get_collections()
+
+
+async def _refresh_readiness(client: AsyncQdrantClient):
+    """
+    Tarea de fondo que actualiza el estado de readiness cada READINESS_INTERVAL.
+    Los checks corren en paralelo y acotados: un backend colgado no bloquea al otro.
+    """
+    global _readiness
+    while True:
+        await asyncio.sleep(READINESS_INTERVAL)
+        results = await asyncio.gather(
+            asyncio.wait_for(_check_database(), READINESS_TIMEOUT),
+            asyncio.wait_for(_check_qdrant(client), READINESS_TIMEOUT),
+            return_exceptions=True
+        )
+        
+        checks = {}
+        for name, result in zip(("database", "qdrant"), results):
+            if isinstance(result, asyncio.TimeoutError):
+                checks[name] = "error: timeout"
+            elif isinstance(result, Exception):
+                checks[name] = f"error: {str(result)}"
+            else:
+                checks[name] = "ok"
+        
+        all_ok = all(v == "ok" for v in checks.values())
+        _readiness = {
+            "status": "ready" if all_ok else "not_ready",
+            "checks": checks
+        }
 
 
 @app.get("/health/ready", tags=["Health"])
 async def readiness_check():
-    from app.core.database import engine
-    
-    checks = {"database": "unknown", "qdrant": "unknown"}
-    
-    try:
-        async with engine.connect() as conn:
-            await conn.execute("SELECT 1")
-        checks["database"] = "ok"
-    except Exception as e:
-        checks["database"] = f"error: {str(e)}"
-    
-    try:
-        from qdrant_client import QdrantClient
-        client = QdrantClient(host=settings.qdrant_host, port=settings.qdrant_port)
-        client.get_collections()
-        checks["qdrant"] = "ok"
-    except Exception as e:
-        checks["qdrant"] = f"error: {str(e)}"
-    
-    all_ok = all(v == "ok" for v in checks.values())
+    # Sin I/O: retorna el último estado calculado por _refresh_readiness
+    return _readiness
+
+
+@app.get("/health/db-pool", tags=["Health"])
+async def db_pool_stats():
+    """
+    Estado del pool de conexiones de Postgres.
+    Solo lee contadores en memoria: no hace I/O contra la base de datos.
+    """
+    pool = engine.pool
+    checked_out = pool.checkedout()
+    capacity = pool.size() + settings.db_max_overflow
     
     return {
-        "status": "ready" if all_ok else "not_ready",
-        "checks": checks
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": checked_out,
+        "overflow": pool.overflow(),
+        "max_overflow": settings.db_max_overflow,
+        "healthy": checked_out < capacity
     }
 
 
 # ===========================================
-# INCLUIR ROUTERS
+# ENDPOINTS DE PRUEBA Y SETUP
 # ===========================================
 
-from app.api.webhooks.whatsapp import router as whatsapp_router
-from app.api.webhooks.voice import router as voice_router
-
-app.include_router(whatsapp_router, prefix="/webhook", tags=["Webhooks"])
-app.include_router(voice_router, prefix="/webhook", tags=["Webhooks"])
+# Solo se incluye en desarrollo: en prod estas rutas no existen
+dev_router = APIRouter()
 
 
-# ===========================================
-# ENDPOINTS DE PRUEBA Y SETUP
-# ===========================================
-
-@app.post("/test/ai", tags=["Test"])
+@dev_router.post("/test/ai", tags=["Test"])
 async def test_ai(message: str = "Hola"):
-    from app.services.ai_service import generate_ai_response
     response = await generate_ai_response(message)
     return {"response": response.message, "status": "ok"}
 
 
-@app.post("/setup/demo-company", tags=["Setup"])
+@dev_router.post("/test/ai/stream", tags=["Test"])
+async def test_ai_stream(message: str = "Hola"):
+    return StreamingResponse(stream_ai_response(message), media_type="text/plain; charset=utf-8")
+
+
+@dev_router.post("/setup/demo-company", tags=["Setup"])
 async def create_demo_company():
-    from app.core.database import async_session_maker
-    from app.models import Company, CompanyConfig
-    from sqlalchemy import select
-    import secrets
-    
     async with async_session_maker() as session:
-        query = select(Company).where(Company.id == "demo_company")
-        result = await session.execute(query)
-        existing = result.scalar_one_or_none()
-        
-        if existing:
-            return {"message": "Demo company already exists", "api_key": existing.api_key}
-        
-        company = Company(
-            id="demo_company",
-            name="Empresa Demo",
-            slug="demo",
-            api_key=f"aie_{secrets.token_hex(24)}",
-            industry="servicios",
-            is_active=True
-        )
-        session.add(company)
-        
-        config = CompanyConfig(
-            company_id="demo_company",
-            agent_name="Asistente Demo",
-            tone="amigable",
-            greeting_message="¡Hola! Soy el asistente de Empresa Demo. ¿En qué puedo ayudarte?",
-            primary_cta="agendar_cita"
-        )
-        session.add(config)
+        async with session.begin():
+            existing = await session.get(Company, "demo_company")
+            
+            if existing:
+                return {"message": "Demo company already exists", "api_key": existing.api_key}
+            
+            company = Company(
+                id="demo_company",
+                name="Empresa Demo",
+                slug="demo",
+                api_key=generate_api_key(),
+                industry="servicios",
+                is_active=True
+            )
+            
+            config = CompanyConfig(
+                company_id="demo_company",
+                agent_name="Asistente Demo",
+                tone="amigable",
+                greeting_message="¡Hola! Soy el asistente de Empresa Demo. ¿En qué puedo ayudarte?",
+                primary_cta="agendar_cita"
+            )
+            
+            # Ambos INSERT en un solo flush; el commit ocurre al salir de begin()
+            session.add_all([company, config])
         
-        await session.commit()
+        invalidate_company_config(company.id)
         
         return {
             "message": "Demo company created",
@@ -246,21 +381,23 @@ async def create_demo_company():
 # KNOWLEDGE BASE
 # ===========================================
 
+knowledge_router = APIRouter(prefix="/knowledge", tags=["Knowledge Base"])
+
 class KnowledgeDocument(BaseModel):
     company_id: str = "demo_company"
     title: str = "Documento"
     content: str
 
 
-@app.post("/knowledge/add", tags=["Knowledge Base"])
+@knowledge_router.post("/add")
 async def add_knowledge_document(doc: KnowledgeDocument):
-    from app.services.rag_service import add_document
-    
     doc_id = await add_document(
         company_id=doc.company_id,
         content=doc.content,
         metadata={"title": doc.title}
     )
+    # Las respuestas y el contexto cacheados (en todos los procesos) pueden no reflejar el documento nuevo
+    await invalidate_company_caches(doc.company_id)
     
     return {
         "message": "Document added",
@@ -269,15 +406,62 @@ async def add_knowledge_document(doc: KnowledgeDocument):
     }
 
 
+class KnowledgeBatchItem(BaseModel):
+    title: str = "Documento"
+    content: str
+
+
+class KnowledgeBatch(BaseModel):
+    company_id: str = "demo_company"
+    documents: List[KnowledgeBatchItem]
+
+
+@knowledge_router.post("/add-batch")
+async def add_knowledge_batch(batch: KnowledgeBatch):
+    """Agrega varios documentos con embeddings y upserts en lote."""
+    doc_ids = await add_documents(
+        company_id=batch.company_id,
+        contents=[doc.content for doc in batch.documents],
+        metadatas=[{"title": doc.title} for doc in batch.documents]
+    )
+    await invalidate_company_caches(batch.company_id)
+    
+    return {
+        "message": "Documents added",
+        "doc_ids": doc_ids,
+        "company_id": batch.company_id
+    }
+
+
+class KnowledgeIngest(BaseModel):
+    company_id: str = "demo_company"
+    title: str = "Documento"
+    contents: List[str]
+
+
+@knowledge_router.post("/ingest")
+async def submit_knowledge_ingest(ingest: KnowledgeIngest):
+    """Carga masiva: los embeddings se calculan con la Batch API (mitad de costo)."""
+    batch_id = await submit_document_ingest(ingest.company_id, ingest.contents, title=ingest.title)
+    return {"batch_id": batch_id, "company_id": ingest.company_id, "count": len(ingest.contents)}
+
+
+@knowledge_router.get("/ingest/{batch_id}")
+async def get_knowledge_ingest(batch_id: str):
+    """Estado del batch de carga; al completarse agrega los documentos a Qdrant."""
+    result = await complete_document_ingest(batch_id)
+    if "company_id" in result and not result.get("already_ingested"):
+        await invalidate_company_caches(result["company_id"])
+    return result
+
+
 class SearchQuery(BaseModel):
     company_id: str = "demo_company"
     query: str = "información"
 
 
-@app.post("/knowledge/search", tags=["Knowledge Base"])
+@knowledge_router.post("/search")
 async def search_knowledge(search: SearchQuery):
-    from app.services.rag_service import search_documents
-    
     results = await search_documents(search.company_id, search.query, limit=5)
     
     return {
@@ -287,22 +471,21 @@ async def search_knowledge(search: SearchQuery):
     }
 
 
-@app.delete("/knowledge/clear", tags=["Knowledge Base"])
-async def clear_knowledge(company_id: str = "demo_company"):
+@knowledge_router.delete("/clear")
+async def clear_knowledge(request: Request, company_id: str = "demo_company"):
     """Borra todos los documentos de una empresa."""
-    from qdrant_client import QdrantClient
-    from app.core.config import settings
-    
     try:
-        client = QdrantClient(host=settings.qdrant_host, port=settings.qdrant_port)
+        client = request.app.state.qdrant
         collection_name = f"company_{company_id}_docs"
         
         # Verificar si existe
-        collections = client.get_collections()
+        collections = await client.get_collections()
         exists = any(c.name == collection_name for c in collections.collections)
         
         if exists:
-            client.delete_collection(collection_name)
+            await client.delete_collection(collection_name)
+            forget_collection(company_id)
+            await invalidate_company_caches(company_id)
             return {"message": f"Collection {collection_name} deleted", "company_id": company_id}
         else:
             return {"message": "Collection not found", "company_id": company_id}
@@ -310,18 +493,15 @@ async def clear_knowledge(company_id: str = "demo_company"):
         return {"error": str(e)}
 
 
-@app.get("/knowledge/debug", tags=["Knowledge Base"])
-async def debug_knowledge(company_id: str = "demo_company"):
+@knowledge_router.get("/debug")
+async def debug_knowledge(request: Request, company_id: str = "demo_company"):
     """Debug: muestra info de la colección de Qdrant."""
-    from qdrant_client import QdrantClient
-    from app.core.config import settings
-    
     try:
-        client = QdrantClient(host=settings.qdrant_host, port=settings.qdrant_port)
+        client = request.app.state.qdrant
         collection_name = f"company_{company_id}_docs"
         
         # Listar colecciones
-        collections = client.get_collections()
+        collections = await client.get_collections()
         collection_names = [c.name for c in collections.collections]
         
         # Info de la colección específica
@@ -329,7 +509,7 @@ async def debug_knowledge(company_id: str = "demo_company"):
         points_sample = []
         
         if collection_name in collection_names:
-            info = client.get_collection(collection_name)
+            info = await client.get_collection(collection_name)
             collection_info = {
                 "name": collection_name,
                 "points_count": info.points_count,
@@ -338,7 +518,7 @@ async def debug_knowledge(company_id: str = "demo_company"):
             
             # Obtener algunos puntos de muestra
             try:
-                scroll_result = client.scroll(
+                scroll_result = await client.scroll(
                     collection_name=collection_name,
                     limit=5,
                     with_payload=True,
@@ -365,14 +545,16 @@ async def debug_knowledge(company_id: str = "demo_company"):
 # FEEDBACK Y MÉTRICAS
 # ===========================================
 
-@app.post("/feedback/rate", tags=["Feedback"])
+feedback_router = APIRouter(prefix="/feedback", tags=["Feedback"])
+metrics_router = APIRouter(prefix="/metrics", tags=["Metrics"])
+
+
+@feedback_router.post("/rate")
 async def rate_message(
     message_id: str,
     rating: int = 5,
     comment: str = None
 ):
-    from app.services.feedback_service import save_feedback
-    
     result = await save_feedback(
         message_id=message_id,
         rating=rating,
@@ -381,32 +563,60 @@ async def rate_message(
     return result
 
 
-@app.get("/metrics/{company_id}", tags=["Metrics"])
+@feedback_router.post("/review/{company_id}")
+async def review_low_rated(company_id: str = "demo_company"):
+    """Envía a la Batch API la revisión de respuestas mal calificadas."""
+    batch_id = await submit_low_rated_review(company_id)
+    if batch_id is None:
+        return {"message": "No low-rated responses to review", "company_id": company_id}
+    return {"batch_id": batch_id, "company_id": company_id}
+
+
+@feedback_router.get("/review/batches/{batch_id}")
+async def get_review_batch(batch_id: str):
+    """Estado del batch de revisión y, si terminó, sus resultados."""
+    return await fetch_batch_results(batch_id)
+
+
+@metrics_router.get("/{company_id}")
 async def get_metrics(company_id: str = "demo_company"):
-    from app.services.feedback_service import get_conversation_metrics
-    
     return await get_conversation_metrics(company_id)
 
 
-@app.get("/metrics/{company_id}/funnel", tags=["Metrics"])
+@metrics_router.get("/{company_id}/funnel")
 async def get_funnel(company_id: str = "demo_company"):
-    from app.services.feedback_service import get_lead_funnel
-    
     return await get_lead_funnel(company_id)
 
 
-@app.get("/metrics/{company_id}/escalations", tags=["Metrics"])
+@metrics_router.get("/{company_id}/escalations")
 async def get_escalations(company_id: str = "demo_company"):
-    from app.services.feedback_service import detect_escalation_patterns
-    
     return await detect_escalation_patterns(company_id)
 
 
+# ===========================================
+# INCLUIR ROUTERS
+# ===========================================
+
+from app.api.webhooks import whatsapp_router, voice_router
+
+app.include_router(whatsapp_router, prefix="/webhook", tags=["Webhooks"])
+app.include_router(voice_router, prefix="/webhook", tags=["Webhooks"])
+app.include_router(knowledge_router)
+app.include_router(feedback_router)
+app.include_router(metrics_router)
+if IS_DEV:
+    app.include_router(dev_router)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
         "app.main:app",
         host="0.0.0.0",
         port=8000,
-        reload=settings.is_development
+        reload=IS_DEV,
+        loop="uvloop",
+        http="httptools",
+        log_level="warning",
+        access_log=False  # el middleware log_requests ya registra los requests
     )
\ No newline at end of file
@@ -6,6 +6,7 @@ from app.models.company import Company
 from app.models.config import CompanyConfig
 from app.models.user import User
 from app.models.conversation import Conversation, Message, Feedback
+from app.models.metrics import DailyMetrics
 
 __all__ = [
     "Company",
@@ -13,5 +14,6 @@ __all__ = [
     "User",
     "Conversation",
     "Message",
-    "Feedback"
+    "Feedback",
+    "DailyMetrics"
 ]
\ No newline at end of file
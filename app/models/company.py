@@ -5,14 +5,19 @@ Cada empresa que usa el AI Engine tiene su propia configuración,
 usuarios, y conversaciones aisladas (multi-tenant).
 """
 
-from sqlalchemy import Column, String, DateTime, Boolean, Text
-from sqlalchemy.orm import relationship
-from datetime import datetime
+from sqlalchemy import Column, String, DateTime, Boolean, Text, LargeBinary, func
+from sqlalchemy.orm import relationship, validates
+import hashlib
 import uuid
 
 from app.core.database import Base
 
 
+def hash_api_key(api_key: str) -> bytes:
+    """Digest de tamaño fijo (16 bytes) de una API key, usado para buscarla."""
+    return hashlib.blake2b(api_key.encode(), digest_size=16).digest()
+
+
 class Company(Base):
     """
     Representa una empresa cliente del sistema.
@@ -27,7 +32,15 @@ class Company(Base):
     slug = Column(String(100), unique=True, comment="Identificador URL-friendly")
     
     # === Autenticación ===
-    api_key = Column(String(100), unique=True, nullable=False, comment="API Key para autenticación")
+    # Sin índice propio: la unicidad y la búsqueda van por api_key_hash
+    api_key = Column(String(100), nullable=False, comment="API Key para autenticación")
+    api_key_hash = Column(
+        LargeBinary(16),
+        unique=True,
+        nullable=False,
+        default=lambda ctx: hash_api_key(ctx.get_current_parameters()["api_key"]),
+        comment="blake2b de la API key (índice de tamaño fijo para la búsqueda)"
+    )
     
     # === Información del negocio ===
     industry = Column(String(100), comment="Industria: restaurante, clinica, ecommerce, etc.")
@@ -44,12 +57,18 @@ class Company(Base):
     is_active = Column(Boolean, default=True, comment="Si la empresa está activa")
     
     # === Timestamps ===
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
     # === Relaciones ===
     users = relationship("User", back_populates="company", cascade="all, delete-orphan")
     config = relationship("CompanyConfig", back_populates="company", uselist=False, cascade="all, delete-orphan")
     
+    @validates("api_key")
+    def _sync_api_key_hash(self, key, api_key):
+        """Mantiene api_key_hash al crear la empresa y al rotar su API key."""
+        self.api_key_hash = hash_api_key(api_key)
+        return api_key
+    
     def __repr__(self):
         return f"<Company {self.name} ({self.id[:8]})>"
\ No newline at end of file
@@ -2,9 +2,8 @@
 Modelo CompanyConfig - Configuración del agente IA por empresa.
 """
 
-from sqlalchemy import Column, String, DateTime, ForeignKey, Text, JSON, Boolean
+from sqlalchemy import Column, String, DateTime, ForeignKey, Text, JSON, Boolean, func
 from sqlalchemy.orm import relationship
-from datetime import datetime
 import uuid
 
 from app.core.database import Base
@@ -53,8 +52,8 @@ class CompanyConfig(Base):
     custom_instructions = Column(Text)
     
     # Timestamps
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
     # Relación
     company = relationship("Company", back_populates="config")
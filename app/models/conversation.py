@@ -2,8 +2,7 @@
 Modelo de Conversación y Mensajes.
 """
 
-from datetime import datetime
-from sqlalchemy import Column, String, DateTime, Text, ForeignKey, Integer, JSON
+from sqlalchemy import Column, String, DateTime, Text, ForeignKey, Integer, JSON, Index, func, text
 from sqlalchemy.orm import relationship
 import uuid
 
@@ -15,14 +14,22 @@ class Conversation(Base):
     Una conversación es una sesión de chat con un usuario.
     """
     __tablename__ = "conversations"
+    __table_args__ = (
+        # Conversación activa del usuario en un canal (get_or_create_conversation)
+        Index(
+            "ix_conversations_user_channel_active",
+            "user_id", "channel", text("last_message_at DESC"),
+            postgresql_where=text("status = 'active'")
+        ),
+    )
     
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
     channel = Column(String, nullable=False)  # whatsapp, messenger, voice, web
     status = Column(String, default="active")  # active, closed, escalated
-    started_at = Column(DateTime, default=datetime.utcnow)
-    ended_at = Column(DateTime, nullable=True)
-    last_message_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime(timezone=True), server_default=func.now())
+    ended_at = Column(DateTime(timezone=True), nullable=True)
+    last_message_at = Column(DateTime(timezone=True), server_default=func.now())
     extra_data = Column(JSON, default=dict)
     
     # Relaciones
@@ -35,6 +42,14 @@ class Message(Base):
     Un mensaje individual en una conversación.
     """
     __tablename__ = "messages"
+    __table_args__ = (
+        # Historial: últimos N mensajes de una conversación con su rol
+        Index(
+            "ix_messages_conversation_created",
+            "conversation_id", text("created_at DESC"),
+            postgresql_include=["role"]
+        ),
+    )
     
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     conversation_id = Column(String, ForeignKey("conversations.id"), nullable=False)
@@ -43,7 +58,7 @@ class Message(Base):
     response_time_ms = Column(Integer, nullable=True)
     tokens_used = Column(Integer, nullable=True)
     model_used = Column(String, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relación
     conversation = relationship("Conversation", back_populates="messages")
@@ -62,7 +77,7 @@ class Feedback(Base):
     feedback_type = Column(String, default="user")  # user, supervisor
     comment = Column(Text, nullable=True)
     corrected_response = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relación
     message = relationship("Message", backref="feedback")
\ No newline at end of file
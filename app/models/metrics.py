@@ -0,0 +1,28 @@
+"""
+Modelo DailyMetrics - Rollup diario de métricas por empresa.
+"""
+
+from sqlalchemy import Column, String, Date, DateTime, ForeignKey, Integer, BigInteger, func
+
+from app.core.database import Base
+
+
+class DailyMetrics(Base):
+    """
+    Métricas agregadas de un día completo para una empresa.
+    Las llena refresh_daily_metrics (feedback_service); el día en curso
+    se calcula en vivo.
+    """
+    __tablename__ = "daily_metrics"
+    
+    company_id = Column(String(36), ForeignKey("companies.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    
+    conversations = Column(Integer, nullable=False, server_default="0")
+    messages = Column(Integer, nullable=False, server_default="0")
+    
+    # Suma y cantidad de tiempos de respuesta del asistente (para el promedio)
+    total_response_ms = Column(BigInteger, nullable=False, server_default="0")
+    response_count = Column(Integer, nullable=False, server_default="0")
+    
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
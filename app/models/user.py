@@ -5,9 +5,8 @@ Representa a las personas que interactúan con el agente IA.
 Guarda información de contacto, estado del lead, y preferencias.
 """
 
-from sqlalchemy import Column, String, DateTime, Integer, ForeignKey, Text, JSON
+from sqlalchemy import Column, String, DateTime, Integer, ForeignKey, Text, JSON, Index, func, text
 from sqlalchemy.orm import relationship
-from datetime import datetime
 import uuid
 
 from app.core.database import Base
@@ -18,6 +17,15 @@ class User(Base):
     Representa un contacto/lead de una empresa.
     """
     __tablename__ = "users"
+    __table_args__ = (
+        # Voz: get_or_create_user busca por (company_id, phone); WhatsApp y
+        # Messenger se resuelven con el índice único de su identificador
+        Index(
+            "ix_users_company_phone",
+            "company_id", "phone",
+            postgresql_where=text("phone IS NOT NULL")
+        ),
+    )
     
     # === Identificación ===
     id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
@@ -42,9 +50,9 @@ class User(Base):
     notes = Column(Text)
     
     # === Timestamps ===
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    last_interaction = Column(DateTime)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    last_interaction = Column(DateTime(timezone=True))
     
     # === Relaciones ===
     company = relationship("Company", back_populates="users")
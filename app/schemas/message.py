@@ -7,7 +7,8 @@ a este formato estándar antes de procesarse.
 
 from pydantic import BaseModel, Field
 from typing import Optional, Literal
-from datetime import datetime
+from datetime import datetime, timezone
+import time
 
 
 class NormalizedMessage(BaseModel):
@@ -19,7 +20,10 @@ class NormalizedMessage(BaseModel):
     user_id: str = Field(..., description="ID único del usuario en ese canal")
     channel: Literal["whatsapp", "messenger", "voice", "web"] = Field(..., description="Canal de origen")
     message: str = Field(..., description="Contenido del mensaje (texto)")
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: int = Field(
+        default_factory=lambda: time.time_ns() // 1_000_000,
+        description="Epoch UTC en milisegundos"
+    )
     metadata: Optional[dict] = Field(default={}, description="Datos extra del canal")
     
     class Config:
@@ -29,10 +33,15 @@ class NormalizedMessage(BaseModel):
                 "user_id": "+50312345678",
                 "channel": "whatsapp",
                 "message": "Hola, quiero información sobre sus servicios",
-                "timestamp": "2024-01-15T10:30:00Z",
+                "timestamp": 1705314600000,
                 "metadata": {"twilio_sid": "SM123"}
             }
         }
+    
+    @property
+    def received_at(self) -> datetime:
+        """Timestamp como datetime UTC (convertir solo donde se necesite)."""
+        return datetime.fromtimestamp(self.timestamp / 1000, tz=timezone.utc)
 
 
 class AgentResponse(BaseModel):
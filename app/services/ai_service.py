@@ -3,42 +3,234 @@ Servicio de IA - Genera respuestas usando OpenAI con soporte RAG.
 """
 
 import openai
-from typing import Optional
+from functools import lru_cache
+from typing import AsyncIterator, Optional
+import asyncio
+import hashlib
+import re
+import orjson
 import structlog
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential
+)
 
 from app.core.config import settings
+from app.core.openai_client import client
+from app.core.llm_cache import (
+    get_cached_response,
+    set_cached_response,
+    get_semantic_response,
+    set_semantic_response
+)
 from app.schemas.message import AgentResponse
-from app.services.rag_service import get_context_for_query
+from app.utils.tokens import count_tokens, truncate_history
+from app.services.rag_service import create_embedding, get_context_for_query
 
 logger = structlog.get_logger()
 
-# Configurar cliente de OpenAI
-client = openai.AsyncOpenAI(api_key=settings.openai_api_key)
+# Tope de requests simultáneos a OpenAI por proceso (evita tormentas de 429)
+_openai_semaphore = asyncio.Semaphore(settings.openai_max_concurrency)
+_exponential_wait = wait_exponential(multiplier=0.5, max=8)
 
+# Tope de espera de un retry-after: un webhook o job no queda esperando minutos
+RETRY_AFTER_MAX = 20.0
 
-async def generate_ai_response(
-    user_message: str,
-    conversation_history: list = None,
-    system_prompt: str = None,
-    company_name: str = "la empresa",
-    company_id: str = None
-) -> AgentResponse:
+# Errores transitorios que se reintentan: 429, conexión/timeout, 409 y 5xx
+# (el cliente compartido tiene max_retries=0, así que los reintentos son estos)
+_RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.ConflictError,
+    openai.InternalServerError,
+)
+
+
+def _wait_retry_after(retry_state) -> float:
+    """Espera lo que indique el header retry-after (hasta RETRY_AFTER_MAX), o backoff exponencial."""
+    exc = retry_state.outcome.exception()
+    response = getattr(exc, "response", None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get("retry-after", "")), RETRY_AFTER_MAX)
+        except ValueError:
+            pass
+    return _exponential_wait(retry_state)
+
+
+_retry_openai = retry(
+    retry=retry_if_exception_type(_RETRYABLE_ERRORS),
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(settings.openai_max_retries + 1),
+    reraise=True
+)
+
+
+@_retry_openai
+async def _create_completion(**kwargs):
+    """chat.completions.create acotado por el semáforo y con reintentos ante errores transitorios."""
+    async with _openai_semaphore:
+        return await client.chat.completions.create(**kwargs)
+
+
+@_retry_openai
+async def _create_stream(**kwargs):
     """
-    Genera una respuesta usando OpenAI GPT-4 con RAG.
+    chat.completions.create con stream=True y reintentos ante errores
+    transitorios. No toma el semáforo: el llamador lo retiene hasta
+    terminar de consumir el stream.
     """
+    return await client.chat.completions.create(stream=True, **kwargs)
+
+# Palabras clave para detectar escalación e intención de cita
+_ESCALATION_KEYWORDS = frozenset({"humano", "persona", "asesor", "queja", "supervisor", "gerente"})
+_APPOINTMENT_KEYWORDS = frozenset({"cita", "agendar", "reservar", "apartar", "programar"})
+
+
+def _alternation(keywords) -> str:
+    return "|".join(map(re.escape, sorted(keywords)))
+
+
+# Un solo patrón con grupos nombrados: una pasada detecta ambas intenciones
+# sin crear una copia en minúsculas del mensaje
+_DEFAULT_KEYWORDS_RE = re.compile(
+    rf"(?P<escalate>{_alternation(_ESCALATION_KEYWORDS)})|(?P<appointment>{_alternation(_APPOINTMENT_KEYWORDS)})",
+    re.IGNORECASE
+)
+_APPOINTMENT_RE = re.compile(_alternation(_APPOINTMENT_KEYWORDS), re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def _escalation_regex(joined_keywords: str) -> re.Pattern:
+    """
+    Regex de escalación de una empresa; se compila una vez por lista de palabras.
+    Coincide como subcadena, igual que las palabras de defecto ("asesores" contiene "asesor").
+    """
+    return re.compile(joined_keywords, re.IGNORECASE)
+
+
+def _classify_message(user_message: str, escalation_keywords: Optional[list]) -> tuple:
+    """
+    Calcula (action, lead_status) a partir del mensaje del usuario.
+    Usa las palabras de escalación de la empresa (CompanyConfig) o las de defecto.
+    """
+    if escalation_keywords:
+        pattern = _escalation_regex("|".join(map(re.escape, escalation_keywords)))
+        escalate = pattern.search(user_message) is not None
+        appointment = _APPOINTMENT_RE.search(user_message) is not None
+    else:
+        found = set()
+        for match in _DEFAULT_KEYWORDS_RE.finditer(user_message):
+            found.add(match.lastgroup)
+            if len(found) == 2:
+                break
+        escalate = "escalate" in found
+        appointment = "appointment" in found
     
-    # Buscar contexto RAG si hay company_id
-    rag_context = ""
-    if company_id:
-        try:
-            rag_context = await get_context_for_query(company_id, user_message)
-            if rag_context:
-                logger.info("rag_context_found", company_id=company_id)
-        except Exception as e:
-            logger.warning("rag_search_failed", error=str(e))
+    action = "escalate" if escalate else None
+    lead_status = "caliente" if appointment else "interesado"
+    return action, lead_status
+
+
+# Salida estructurada: la respuesta y su clasificación en la misma llamada.
+# JSON mode (json_object) funciona con OPENAI_MODEL por defecto
+# (gpt-4-turbo-preview), que no soporta json_schema; las claves se piden
+# en el system prompt
+_RESPONSE_FORMAT = {"type": "json_object"}
+
+_JSON_INSTRUCTIONS = """FORMATO DE RESPUESTA:
+Responde siempre con un objeto JSON con exactamente estas claves:
+- "message": tu respuesta para el cliente (texto)
+- "action": "escalate" si el cliente pide hablar con un humano, se queja o está frustrado; si no, null
+- "lead_status": "caliente" si el cliente quiere agendar, reservar o comprar; si no, "interesado"
+"""
+
+# Respuesta si el JSON no trae un mensaje recuperable
+_FALLBACK_MESSAGE = "Disculpa, tuve un problema al responder. ¿Podrías intentar de nuevo?"
+
+# Valor (posiblemente incompleto) de "message" en un JSON cortado por max_tokens
+_PARTIAL_MESSAGE_RE = re.compile(r'"message"\s*:\s*"((?:[^"\\]|\\.)*)')
+_PARTIAL_ESCAPE_RE = re.compile(r"\\u[0-9a-fA-F]{0,3}$")
+
+
+@lru_cache(maxsize=1024)
+def _json_instructions(escalation_keywords: tuple) -> str:
+    """Instrucciones de formato; con las palabras de escalación de la empresa si tiene."""
+    if not escalation_keywords:
+        return _JSON_INSTRUCTIONS
+    return (
+        _JSON_INSTRUCTIONS
+        + "- Usa \"escalate\" también si el cliente menciona alguna de estas palabras: "
+        + ", ".join(escalation_keywords)
+        + "\n"
+    )
+
+
+def _recover_message(content: Optional[str]) -> str:
+    """
+    Texto para el cliente cuando el JSON no es válido: el valor de "message"
+    aunque el JSON esté cortado, el texto tal cual si no es JSON, o un
+    mensaje fijo. Nunca se envía JSON crudo al cliente.
+    """
+    text = (content or "").strip()
+    if not text:
+        return _FALLBACK_MESSAGE
+    if not text.startswith("{"):
+        return text
+    
+    match = _PARTIAL_MESSAGE_RE.search(text)
+    if match:
+        raw = match.group(1)
+        for candidate in (raw, _PARTIAL_ESCAPE_RE.sub("", raw)):
+            try:
+                message = orjson.loads(f'"{candidate}"').strip()
+            except orjson.JSONDecodeError:
+                continue
+            if message:
+                return message
+    return _FALLBACK_MESSAGE
+
+
+def _parse_structured(
+    content: Optional[str],
+    finish_reason: Optional[str],
+    user_message: str,
+    escalation_keywords: Optional[list]
+) -> tuple:
+    """
+    Extrae (message, action, lead_status) del JSON del modelo.
+    Si el JSON no es válido (p. ej. cortado por max_tokens) se recupera el
+    mensaje con _recover_message y se clasifica por palabras clave.
+    """
+    try:
+        data = orjson.loads(content)
+        message = data["message"]
+        action = data.get("action")
+        lead_status = data.get("lead_status")
+        if isinstance(message, str) and action in (None, "escalate") and lead_status in ("interesado", "caliente"):
+            return message, action, lead_status
+    except (orjson.JSONDecodeError, TypeError, KeyError, AttributeError):
+        pass
     
-    if not system_prompt:
-        system_prompt = f"""Eres el asistente virtual de {company_name}. Ayudas a los clientes con información sobre servicios, precios y citas.
+    logger.warning(
+        "structured_output_fallback",
+        finish_reason=finish_reason,
+        response_preview=(content or "")[:50]
+    )
+    action, lead_status = _classify_message(user_message, escalation_keywords)
+    return _recover_message(content), action, lead_status
+
+
+# Nota que se agrega al prompt cuando no hay contexto RAG
+_NO_CONTEXT_NOTE = "NOTA: No hay información específica cargada sobre la empresa aún. Ofrece conectar con un asesor para más detalles."
+
+
+@lru_cache(maxsize=512)
+def _base_system_prompt(company_name: str) -> str:
+    """System prompt por defecto; se construye una vez por nombre de empresa."""
+    return f"""Eres el asistente virtual de {company_name}. Ayudas a los clientes con información sobre servicios, precios y citas.
 
 ESTILO DE COMUNICACIÓN:
 - Responde de forma natural y conversacional, como un humano amable
@@ -56,65 +248,200 @@ REGLAS:
 
 Mantén un tono cálido pero no exagerado."""
 
+
+@lru_cache(maxsize=1024)
+def _prompt_variant(company_name: str, escalation_keywords: tuple) -> str:
+    """
+    Variante del prompt por defecto para la llave del cache de respuestas:
+    además del mensaje, la respuesta depende del nombre de la empresa y de
+    las palabras de escalación que van en las instrucciones.
+    """
+    raw = _base_system_prompt(company_name) + "\0" + "\0".join(escalation_keywords)
+    return hashlib.blake2b(raw.encode(), digest_size=8).hexdigest()
+
+
+@lru_cache(maxsize=1024)
+def _full_system_prompt(company_name: str, rag_context: str) -> str:
+    """
+    Prompt por defecto + contexto RAG (o la nota sin contexto), armado una vez
+    por combinación: el contexto de una consulta repetida viene del cache RAG
+    y el prompt resultante se reutiliza sin volver a concatenar.
+    """
+    return _base_system_prompt(company_name) + "\n\n" + (rag_context or _NO_CONTEXT_NOTE)
+
+
+async def get_rag_context(company_id: Optional[str], user_message: str) -> str:
+    """
+    Busca contexto RAG para el mensaje; retorna "" si no hay empresa o si falla.
+    """
+    if not company_id:
+        return ""
+    try:
+        rag_context = await get_context_for_query(company_id, user_message)
+        if rag_context:
+            logger.info("rag_context_found", company_id=company_id)
+        return rag_context
+    except Exception as e:
+        logger.warning("rag_search_failed", error=str(e))
+        return ""
+
+
+def _build_messages(
+    user_message: str,
+    conversation_history: Optional[list],
+    system_prompt: Optional[str],
+    company_name: str,
+    rag_context: str,
+    response_instructions: Optional[str] = None
+) -> list:
+    """
+    Construye los mensajes: system (+ contexto RAG) + historial + mensaje actual.
+    response_instructions se agrega al final del system prompt (formato JSON).
+    El historial se recorta desde los mensajes más viejos para que el prompt
+    no supere OPENAI_PROMPT_TOKEN_BUDGET.
+    """
     # Agregar contexto RAG al system prompt
-    if rag_context:
-        system_prompt += f"\n\n{rag_context}"
+    if system_prompt:
+        system_prompt = system_prompt + "\n\n" + (rag_context or _NO_CONTEXT_NOTE)
     else:
-        system_prompt += f"\n\nNOTA: No hay información específica cargada sobre la empresa aún. Ofrece conectar con un asesor para más detalles."
-
-    # Construir mensajes
-    messages = [
-        {"role": "system", "content": system_prompt}
-    ]
+        system_prompt = _full_system_prompt(company_name, rag_context)
+    if response_instructions:
+        system_prompt = system_prompt + "\n\n" + response_instructions
     
-    # Agregar historial si existe (para memoria de conversación)
     if conversation_history:
-        messages.extend(conversation_history)
+        history_budget = (
+            settings.openai_prompt_token_budget
+            - count_tokens(system_prompt)
+            - count_tokens(user_message)
+        )
+        trimmed = truncate_history(conversation_history, max(history_budget, 0))
+        if len(trimmed) < len(conversation_history):
+            logger.info(
+                "history_truncated",
+                kept=len(trimmed),
+                dropped=len(conversation_history) - len(trimmed)
+            )
+        conversation_history = trimmed
+    
+    return [
+        {"role": "system", "content": system_prompt},
+        *(conversation_history or ()),
+        {"role": "user", "content": user_message}
+    ]
+
+
+async def generate_ai_response(
+    user_message: str,
+    conversation_history: list = None,
+    system_prompt: str = None,
+    company_name: str = "la empresa",
+    company_id: str = None,
+    escalation_keywords: list = None,
+    rag_context: Optional[str] = None
+) -> AgentResponse:
+    """
+    Genera una respuesta usando OpenAI GPT-4 con RAG.
+    
+    escalation_keywords: palabras de escalación de la empresa (CompanyConfig);
+    si no se pasan se usan las de defecto.
+    rag_context: contexto RAG ya obtenido por el llamador; si es None se busca aquí.
+    
+    El modelo retorna JSON con message, action y lead_status (salida
+    estructurada); las palabras de escalación de la empresa van en el
+    prompt y la clasificación por palabras clave solo se usa si el JSON
+    no es válido.
     
-    # Agregar mensaje actual
-    messages.append({"role": "user", "content": user_message})
+    Sin historial la respuesta solo depende del mensaje, así que se busca en
+    el cache (exacto y luego semántico) antes de llamar a OpenAI; la respuesta
+    cacheada trae la clasificación del mismo mensaje o de uno equivalente.
+    """
+    use_cache = not conversation_history and not system_prompt
+    keywords = tuple(escalation_keywords or ())
+    variant = _prompt_variant(company_name, keywords) if use_cache else ""
+    query_embedding = None
+    if use_cache:
+        cached = get_cached_response(company_id, user_message, variant)
+        cache_hit = "exact" if cached else None
+        
+        if cached is None and company_id:
+            try:
+                query_embedding = await create_embedding(user_message)
+                cached = get_semantic_response(company_id, query_embedding, variant)
+                cache_hit = "semantic" if cached else None
+            except Exception as e:
+                logger.warning("semantic_cache_embedding_failed", error=str(e))
+        
+        if cached is not None:
+            logger.info(
+                "ai_response_cached",
+                cache_hit=cache_hit,
+                message_preview=user_message[:50],
+                response_preview=cached.message[:50]
+            )
+            return cached
+    
+    # Buscar contexto RAG si el llamador no lo trajo
+    if rag_context is None:
+        rag_context = await get_rag_context(company_id, user_message)
+    
+    messages = _build_messages(
+        user_message,
+        conversation_history,
+        system_prompt,
+        company_name,
+        rag_context,
+        response_instructions=_json_instructions(keywords)
+    )
     
     try:
         logger.info(
             "calling_openai", 
             message_preview=user_message[:50], 
             has_rag=bool(rag_context),
-            history_length=len(conversation_history) if conversation_history else 0
+            history_length=len(conversation_history) if conversation_history else 0,
+            cache_hit=False
         )
         
-        response = await client.chat.completions.create(
+        response = await _create_completion(
             model=settings.openai_model,
             messages=messages,
             temperature=0.7,
-            max_tokens=300
+            max_tokens=350,
+            response_format=_RESPONSE_FORMAT
         )
         
-        ai_message = response.choices[0].message.content
+        choice = response.choices[0]
+        ai_message, action, lead_status = _parse_structured(
+            choice.message.content,
+            choice.finish_reason,
+            user_message,
+            escalation_keywords
+        )
         tokens_used = response.usage.total_tokens
         
         logger.info(
             "openai_response",
             tokens=tokens_used,
-            response_preview=ai_message[:50]
+            response_preview=ai_message[:50],
+            action=action,
+            lead_status=lead_status
         )
         
-        # Detectar si debe escalar
-        action = None
-        if any(word in user_message.lower() for word in ["humano", "persona", "asesor", "queja", "supervisor", "gerente"]):
-            action = "escalate"
-        
-        # Detectar intención de cita
-        lead_status = "interesado"
-        if any(word in user_message.lower() for word in ["cita", "agendar", "reservar", "apartar", "programar"]):
-            lead_status = "caliente"
-        
-        return AgentResponse(
+        agent_response = AgentResponse(
             message=ai_message,
             action=action,
             lead_status=lead_status,
             confidence=0.9
         )
         
+        # Una respuesta cortada por max_tokens no se cachea
+        if use_cache and choice.finish_reason != "length":
+            set_cached_response(company_id, user_message, agent_response, variant)
+            if query_embedding is not None:
+                set_semantic_response(company_id, query_embedding, agent_response, variant)
+        
+        return agent_response
+    
     except openai.APIError as e:
         logger.error("openai_api_error", error=str(e))
         return AgentResponse(
@@ -130,4 +457,79 @@ Mantén un tono cálido pero no exagerado."""
             action=None,
             lead_status=None,
             confidence=0.0
-        )
\ No newline at end of file
+        )
+
+
+async def stream_ai_response(
+    user_message: str,
+    conversation_history: list = None,
+    system_prompt: str = None,
+    company_name: str = "la empresa",
+    company_id: str = None,
+    escalation_keywords: list = None,
+    rag_context: Optional[str] = None
+) -> AsyncIterator[str]:
+    """
+    Igual que generate_ai_response pero entrega el texto por fragmentos
+    a medida que llegan de OpenAI (stream=True), para canales que pueden
+    mostrar la respuesta mientras se genera.
+    
+    Al terminar el stream la respuesta completa se cachea como en
+    generate_ai_response (solo sin historial ni prompt propio). El texto
+    llega sin JSON, así que action y lead_status salen de las palabras clave.
+    """
+    use_cache = not conversation_history and not system_prompt
+    variant = _prompt_variant(company_name, tuple(escalation_keywords or ())) if use_cache else ""
+    if use_cache:
+        cached = get_cached_response(company_id, user_message, variant)
+        if cached is not None:
+            logger.info("ai_response_cached", cache_hit="exact", message_preview=user_message[:50])
+            yield cached.message
+            return
+    
+    if rag_context is None:
+        rag_context = await get_rag_context(company_id, user_message)
+    
+    messages = _build_messages(user_message, conversation_history, system_prompt, company_name, rag_context)
+    parts = []
+    
+    try:
+        logger.info(
+            "calling_openai_stream",
+            message_preview=user_message[:50],
+            has_rag=bool(rag_context),
+            history_length=len(conversation_history) if conversation_history else 0
+        )
+        
+        # El semáforo se retiene mientras llegan los fragmentos, no solo al abrir el stream
+        async with _openai_semaphore:
+            stream = await _create_stream(
+                model=settings.openai_model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=300
+            )
+            
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    delta = chunk.choices[0].delta.content
+                    parts.append(delta)
+                    yield delta
+    
+    except Exception as e:
+        logger.error("openai_stream_error", error=str(e))
+        if not parts:
+            yield "Disculpa, tengo problemas técnicos. ¿Podrías intentar de nuevo?"
+        return
+    
+    ai_message = "".join(parts)
+    logger.info("openai_stream_completed", response_preview=ai_message[:50])
+    
+    if use_cache:
+        action, lead_status = _classify_message(user_message, escalation_keywords)
+        set_cached_response(company_id, user_message, AgentResponse(
+            message=ai_message,
+            action=action,
+            lead_status=lead_status,
+            confidence=0.9
+        ), variant)
@@ -0,0 +1,245 @@
+"""
+Servicio de IA por lotes - Usa la Batch API de OpenAI para tareas no interactivas.
+
+Las tareas de análisis (revisión de respuestas mal calificadas, resúmenes)
+y la carga masiva de documentos (embeddings) toleran minutos u horas de
+espera; la Batch API cuesta la mitad que el endpoint en tiempo real.
+generate_ai_response y los embeddings de consultas siguen en tiempo real.
+"""
+
+from typing import Optional
+import orjson
+import structlog
+from cachetools import TTLCache
+
+from app.core.config import settings
+from app.core.openai_client import client
+from app.core.queue import get_cache_redis
+from app.services.feedback_service import get_low_rated_responses
+from app.services.rag_service import EMBEDDING_DIMENSION, add_embedded_documents
+
+logger = structlog.get_logger()
+
+# Ventana de procesamiento de la Batch API
+BATCH_COMPLETION_WINDOW = "24h"
+
+# Resultado de las cargas ya aplicadas a Qdrant (en memoria y en Redis si hay),
+# para que volver a consultar un batch terminado no repita la carga
+INGEST_RESULT_TTL = 7 * 24 * 3600
+_ingest_results: TTLCache = TTLCache(maxsize=1024, ttl=INGEST_RESULT_TTL)
+
+_REVIEW_PROMPT = (
+    "Eres un supervisor de calidad de un asistente de atención al cliente. "
+    "Recibirás una respuesta que un cliente calificó mal, junto con su comentario. "
+    "Explica en una oración qué falló y propone una respuesta mejorada y concisa."
+)
+
+
+def build_chat_request(custom_id: str, messages: list, max_tokens: int = 300) -> dict:
+    """Arma una línea del JSONL de la Batch API para /v1/chat/completions."""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": settings.openai_model,
+            "messages": messages,
+            "max_tokens": max_tokens
+        }
+    }
+
+
+def build_embedding_request(custom_id: str, text: str) -> dict:
+    """Arma una línea del JSONL de la Batch API para /v1/embeddings."""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/embeddings",
+        "body": {
+            "model": settings.openai_embedding_model,
+            "input": text,
+            "dimensions": EMBEDDING_DIMENSION
+        }
+    }
+
+
+async def _read_jsonl(file_id: str) -> list:
+    content = await client.files.content(file_id)
+    return [orjson.loads(line) for line in content.content.splitlines() if line.strip()]
+
+
+async def submit_chat_batch(
+    requests: list,
+    metadata: Optional[dict] = None,
+    endpoint: str = "/v1/chat/completions"
+) -> str:
+    """
+    Sube las requests como un archivo JSONL y crea el batch.
+    Retorna el ID del batch para consultar el resultado después.
+    """
+    jsonl = b"\n".join(orjson.dumps(r) for r in requests)
+    batch_file = await client.files.create(
+        file=("batch.jsonl", jsonl),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=endpoint,
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata=metadata
+    )
+    
+    logger.info("ai_batch_submitted", batch_id=batch.id, requests=len(requests))
+    return batch.id
+
+
+async def fetch_batch_results(batch_id: str) -> dict:
+    """
+    Consulta un batch. Mientras no termina retorna solo el estado;
+    al completarse agrega results: custom_id -> texto generado (o error).
+    """
+    batch = await client.batches.retrieve(batch_id)
+    response = {"batch_id": batch_id, "status": batch.status}
+    
+    if batch.status != "completed" or not batch.output_file_id:
+        return response
+    
+    results = {}
+    for item in await _read_jsonl(batch.output_file_id):
+        if item.get("error"):
+            results[item["custom_id"]] = {"error": item["error"]}
+            continue
+        body = item["response"]["body"]
+        results[item["custom_id"]] = body["choices"][0]["message"]["content"]
+    
+    response["results"] = results
+    logger.info("ai_batch_completed", batch_id=batch_id, results=len(results))
+    return response
+
+
+async def submit_low_rated_review(company_id: str, limit: int = 50) -> Optional[str]:
+    """
+    Envía a la Batch API la revisión de las respuestas mal calificadas
+    de una empresa. Retorna el ID del batch, o None si no hay nada que revisar.
+    """
+    responses = await get_low_rated_responses(company_id, min_count=limit)
+    if not responses:
+        return None
+    
+    requests = [
+        build_chat_request(
+            custom_id=f"{company_id}-review-{i}",
+            messages=[
+                {"role": "system", "content": _REVIEW_PROMPT},
+                {
+                    "role": "user",
+                    "content": (
+                        f"Respuesta: {item['response']}\n"
+                        f"Calificación: {item['rating']}\n"
+                        f"Comentario: {item['comment'] or 'sin comentario'}"
+                    )
+                }
+            ]
+        )
+        for i, item in enumerate(responses)
+    ]
+    
+    return await submit_chat_batch(
+        requests,
+        metadata={"company_id": company_id, "task": "low_rated_review"}
+    )
+
+
+async def submit_document_ingest(company_id: str, contents: list, title: str = "Documento") -> str:
+    """
+    Envía a la Batch API los embeddings de una carga masiva de documentos.
+    Los documentos se agregan a Qdrant con complete_document_ingest cuando
+    el batch termina. Retorna el ID del batch.
+    """
+    requests = [
+        build_embedding_request(custom_id=f"{company_id}-doc-{i}", text=content)
+        for i, content in enumerate(contents)
+    ]
+    
+    return await submit_chat_batch(
+        requests,
+        metadata={"company_id": company_id, "task": "document_ingest", "title": title[:512]},
+        endpoint="/v1/embeddings"
+    )
+
+
+async def _get_ingest_result(batch_id: str) -> Optional[dict]:
+    result = _ingest_results.get(batch_id)
+    if result is not None:
+        return result
+    
+    redis = await get_cache_redis()
+    if redis is None:
+        return None
+    try:
+        data = await redis.get(f"ingest:{batch_id}")
+    except Exception as e:
+        logger.warning("ingest_result_cache_error", error=str(e))
+        return None
+    if data is None:
+        return None
+    
+    result = orjson.loads(data)
+    _ingest_results[batch_id] = result
+    return result
+
+
+async def _set_ingest_result(batch_id: str, result: dict):
+    _ingest_results[batch_id] = result
+    
+    redis = await get_cache_redis()
+    if redis is None:
+        return
+    try:
+        await redis.setex(f"ingest:{batch_id}", INGEST_RESULT_TTL, orjson.dumps(result))
+    except Exception as e:
+        logger.warning("ingest_result_cache_error", error=str(e))
+
+
+async def complete_document_ingest(batch_id: str) -> dict:
+    """
+    Consulta un batch de submit_document_ingest. Al completarse agrega a
+    Qdrant los documentos embebidos: el texto sale del archivo de entrada
+    y el vector del de salida. La carga se aplica una sola vez; las
+    consultas siguientes retornan el resultado guardado.
+    """
+    stored = await _get_ingest_result(batch_id)
+    if stored is not None:
+        return {**stored, "already_ingested": True}
+    
+    batch = await client.batches.retrieve(batch_id)
+    response = {"batch_id": batch_id, "status": batch.status}
+    
+    if batch.status != "completed" or not batch.output_file_id:
+        return response
+    
+    company_id = batch.metadata["company_id"]
+    texts = {
+        item["custom_id"]: item["body"]["input"]
+        for item in await _read_jsonl(batch.input_file_id)
+    }
+    
+    contents, embeddings, errors = [], [], []
+    for item in await _read_jsonl(batch.output_file_id):
+        if item.get("error"):
+            errors.append(item["custom_id"])
+            continue
+        contents.append(texts[item["custom_id"]])
+        embeddings.append(item["response"]["body"]["data"][0]["embedding"])
+    
+    doc_ids = await add_embedded_documents(
+        company_id,
+        contents,
+        embeddings,
+        metadata={"title": batch.metadata.get("title", "Documento")}
+    )
+    
+    response.update(company_id=company_id, doc_ids=doc_ids, errors=errors)
+    await _set_ingest_result(batch_id, response)
+    logger.info("document_ingest_completed", batch_id=batch_id, documents=len(doc_ids), errors=len(errors))
+    return response
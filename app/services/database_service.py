@@ -2,63 +2,139 @@
 Servicio de Base de Datos - Gestiona usuarios, conversaciones y mensajes.
 """
 
-from datetime import datetime, timedelta
-from typing import Optional
-from sqlalchemy import select, and_
+from contextlib import asynccontextmanager, suppress
+from datetime import timedelta
+from typing import AsyncIterator, Optional
+from sqlalchemy import select, update, and_, func, bindparam, Interval
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from cachetools import TTLCache
+import asyncio
 import structlog
 
 from app.models import Company, User, Conversation, Message, CompanyConfig
 from app.core.database import async_session_maker
+from app.core.history_cache import get_cached_history, warm_history
 
 logger = structlog.get_logger()
 
+# Cache de company_id -> CompanyConfig; la configuración cambia muy poco
+COMPANY_CONFIG_CACHE_TTL = 60
+_config_cache: TTLCache = TTLCache(maxsize=1024, ttl=COMPANY_CONFIG_CACHE_TTL)
+
+# Write-behind: cada cuánto se vacía la cola (segundos), máximo por lote y tamaño de la cola
+WRITE_BEHIND_INTERVAL = 0.05
+WRITE_BEHIND_MAX_BATCH = 500
+WRITE_BEHIND_QUEUE_SIZE = 10_000
+# Espera (segundos) antes de reintentar un lote fallido
+WRITE_BEHIND_RETRY_DELAY = 1.0
+
+_write_queue: Optional[asyncio.Queue] = None
+_writer_task: Optional[asyncio.Task] = None
+
+# Consultas del camino crítico: se construyen una vez y se ejecutan con
+# parámetros, así cada request reutiliza la misma sentencia (y su SQL compilado)
+_Q_USER_BY_PHONE = select(User).where(
+    and_(User.company_id == bindparam("company_id"), User.phone == bindparam("phone"))
+)
+
+_Q_ACTIVE_CONVERSATION_ID = select(Conversation.id).where(
+    and_(
+        Conversation.user_id == bindparam("user_id"),
+        Conversation.channel == bindparam("channel"),
+        Conversation.status == "active",
+        Conversation.last_message_at >= func.now() - bindparam("timeout", type_=Interval)
+    )
+).order_by(Conversation.last_message_at.desc()).limit(1)
+
+_Q_HISTORY = select(Message.role, Message.content).where(
+    Message.conversation_id == bindparam("conversation_id")
+).order_by(Message.created_at.desc()).limit(bindparam("limit"))
+
+_Q_COMPANY_CONFIG = select(CompanyConfig).where(
+    CompanyConfig.company_id == bindparam("company_id")
+)
+
+_UPDATE_LAST_MESSAGE_AT = update(Conversation).where(
+    Conversation.id == bindparam("conv_id")
+).values(last_message_at=func.now()).execution_options(synchronize_session=False)
+
+_UPDATE_LEAD_STATUS = update(User).where(
+    User.id == bindparam("target_id")
+).values(lead_status=bindparam("status")).execution_options(synchronize_session=False)
+
+
+@asynccontextmanager
+async def session_scope(session: Optional[AsyncSession] = None) -> AsyncIterator[AsyncSession]:
+    """
+    Usa la sesión del llamador o abre una propia.
+    
+    Con sesión del llamador solo se hace flush: el commit queda a cargo de quien
+    la abrió, y varias operaciones comparten una conexión y una transacción.
+    Con sesión propia se hace commit al salir.
+    """
+    if session is not None:
+        yield session
+        await session.flush()
+        return
+    
+    async with async_session_maker() as own_session:
+        yield own_session
+        await own_session.commit()
+
 
 async def get_or_create_user(
     company_id: str,
     channel: str,
-    channel_user_id: str
+    channel_user_id: str,
+    session: Optional[AsyncSession] = None
 ) -> User:
     """
     Obtiene un usuario existente o crea uno nuevo.
+    WhatsApp y Messenger tienen identificador único: se resuelve con un solo
+    INSERT ... ON CONFLICT DO UPDATE ... RETURNING.
     """
-    async with async_session_maker() as session:
-        # Buscar usuario por canal
-        if channel == "whatsapp":
-            query = select(User).where(
-                and_(User.company_id == company_id, User.whatsapp_id == channel_user_id)
-            )
-        elif channel == "messenger":
-            query = select(User).where(
-                and_(User.company_id == company_id, User.messenger_id == channel_user_id)
-            )
-        else:
-            query = select(User).where(
-                and_(User.company_id == company_id, User.phone == channel_user_id)
-            )
+    async with session_scope(session) as session:
+        if channel in ("whatsapp", "messenger"):
+            channel_column = User.whatsapp_id if channel == "whatsapp" else User.messenger_id
+            stmt = insert(User).values(
+                company_id=company_id,
+                lead_status="nuevo",
+                last_interaction=func.now(),
+                **{channel_column.key: channel_user_id}
+            ).on_conflict_do_update(
+                index_elements=[channel_column],
+                set_={"last_interaction": func.now()},
+                where=User.company_id == company_id
+            ).returning(User)
+            
+            result = await session.scalars(stmt, execution_options={"populate_existing": True})
+            user = result.one()
+            logger.info("user_upserted", user_id=user.id)
+            return user
         
-        result = await session.execute(query)
+        # Voz: el teléfono no es único, buscar y luego crear
+        result = await session.execute(
+            _Q_USER_BY_PHONE,
+            {"company_id": company_id, "phone": channel_user_id}
+        )
         user = result.scalar_one_or_none()
         
         if user:
             # Actualizar última interacción
-            user.last_interaction = datetime.utcnow()
-            await session.commit()
+            user.last_interaction = func.now()
             logger.info("user_found", user_id=user.id)
             return user
         
         # Crear nuevo usuario
         user = User(
             company_id=company_id,
-            whatsapp_id=channel_user_id if channel == "whatsapp" else None,
-            messenger_id=channel_user_id if channel == "messenger" else None,
-            phone=channel_user_id if channel == "voice" else None,
+            phone=channel_user_id,
             lead_status="nuevo",
-            last_interaction=datetime.utcnow()
+            last_interaction=func.now()
         )
         session.add(user)
-        await session.commit()
-        await session.refresh(user)
+        await session.flush()
         
         logger.info("user_created", user_id=user.id)
         return user
@@ -67,46 +143,36 @@ async def get_or_create_user(
 async def get_or_create_conversation(
     user_id: str,
     channel: str,
-    timeout_minutes: int = 30
-) -> Conversation:
+    timeout_minutes: int = 30,
+    session: Optional[AsyncSession] = None
+) -> str:
     """
-    Obtiene conversación activa o crea una nueva.
+    Obtiene el ID de la conversación activa o crea una nueva.
     Una conversación se considera activa si tuvo actividad en los últimos N minutos.
+    Solo se lee el ID: los llamadores no necesitan el resto de la fila.
     """
-    async with async_session_maker() as session:
+    async with session_scope(session) as session:
         # Buscar conversación activa reciente
-        cutoff_time = datetime.utcnow() - timedelta(minutes=timeout_minutes)
-        
-        query = select(Conversation).where(
-            and_(
-                Conversation.user_id == user_id,
-                Conversation.channel == channel,
-                Conversation.status == "active",
-                Conversation.last_message_at >= cutoff_time
-            )
+        conversation_id = await session.scalar(
+            _Q_ACTIVE_CONVERSATION_ID,
+            {"user_id": user_id, "channel": channel, "timeout": timedelta(minutes=timeout_minutes)}
         )
         
-        result = await session.execute(query)
-        conversation = result.scalar_one_or_none()
-        
-        if conversation:
-            logger.info("conversation_found", conversation_id=conversation.id)
-            return conversation
+        if conversation_id:
+            logger.info("conversation_found", conversation_id=conversation_id)
+            return conversation_id
         
         # Crear nueva conversación
         conversation = Conversation(
             user_id=user_id,
             channel=channel,
-            status="active",
-            started_at=datetime.utcnow(),
-            last_message_at=datetime.utcnow()
+            status="active"
         )
         session.add(conversation)
-        await session.commit()
-        await session.refresh(conversation)
+        await session.flush()
         
         logger.info("conversation_created", conversation_id=conversation.id)
-        return conversation
+        return conversation.id
 
 
 async def save_message(
@@ -115,32 +181,27 @@ async def save_message(
     content: str,
     response_time_ms: int = None,
     tokens_used: int = None,
-    model_used: str = None
+    model_used: str = None,
+    session: Optional[AsyncSession] = None
 ) -> Message:
     """
     Guarda un mensaje en la conversación.
     """
-    async with async_session_maker() as session:
+    async with session_scope(session) as session:
         message = Message(
             conversation_id=conversation_id,
             role=role,
             content=content,
             response_time_ms=response_time_ms,
             tokens_used=tokens_used,
-            model_used=model_used,
-            created_at=datetime.utcnow()
+            model_used=model_used
         )
         session.add(message)
         
-        # Actualizar last_message_at en la conversación
-        query = select(Conversation).where(Conversation.id == conversation_id)
-        result = await session.execute(query)
-        conversation = result.scalar_one_or_none()
-        if conversation:
-            conversation.last_message_at = datetime.utcnow()
+        await session.flush()
         
-        await session.commit()
-        await session.refresh(message)
+        # Actualizar last_message_at en la conversación (UPDATE directo, sin SELECT previo)
+        await session.execute(_UPDATE_LAST_MESSAGE_AT, {"conv_id": conversation_id})
         
         logger.info("message_saved", message_id=message.id, role=role)
         return message
@@ -148,52 +209,196 @@ async def save_message(
 
 async def get_conversation_history(
     conversation_id: str,
-    limit: int = 10
+    limit: int = 10,
+    session: Optional[AsyncSession] = None
 ) -> list:
     """
     Obtiene el historial de mensajes de una conversación.
     Retorna en formato listo para OpenAI.
+    
+    Primero busca la ventana en Redis; si no está, lee Postgres y la carga.
     """
-    async with async_session_maker() as session:
-        query = select(Message).where(
-            Message.conversation_id == conversation_id
-        ).order_by(Message.created_at.desc()).limit(limit)
-        
-        result = await session.execute(query)
-        messages = result.scalars().all()
+    cached = await get_cached_history(conversation_id, limit)
+    if cached is not None:
+        return cached
+    
+    async with session_scope(session) as session:
+        # Solo rol y contenido: filas livianas, sin objetos Message
+        result = await session.execute(
+            _Q_HISTORY,
+            {"conversation_id": conversation_id, "limit": limit}
+        )
+        rows = result.all()
         
         # Convertir a formato OpenAI (orden cronológico)
-        history = []
-        for msg in reversed(messages):
-            history.append({
-                "role": msg.role,
-                "content": msg.content
-            })
-        
-        return history
+        history = [{"role": role, "content": content} for role, content in reversed(rows)]
+    
+    await warm_history(conversation_id, history)
+    return history
 
 
 async def get_company_config(company_id: str) -> Optional[CompanyConfig]:
     """
     Obtiene la configuración del agente para una empresa.
+    Se cachea COMPANY_CONFIG_CACHE_TTL segundos, incluso si no existe (None).
     """
+    if company_id in _config_cache:
+        return _config_cache[company_id]
+    
     async with async_session_maker() as session:
-        query = select(CompanyConfig).where(CompanyConfig.company_id == company_id)
-        result = await session.execute(query)
-        return result.scalar_one_or_none()
+        result = await session.execute(_Q_COMPANY_CONFIG, {"company_id": company_id})
+        config = result.scalar_one_or_none()
+    
+    _config_cache[company_id] = config
+    return config
+
+
+def invalidate_company_config(company_id: Optional[str] = None):
+    """
+    Invalida el cache de configuración (una empresa o todo).
+    Llamar después de crear o modificar una CompanyConfig.
+    """
+    if company_id is None:
+        _config_cache.clear()
+    else:
+        _config_cache.pop(company_id, None)
+
+
+async def update_user_lead_status(
+    user_id: str,
+    status: str,
+    session: Optional[AsyncSession] = None
+):
+    """
+    Actualiza el estado del lead con un solo UPDATE (updated_at lo pone onupdate).
+    """
+    async with session_scope(session) as session:
+        result = await session.execute(
+            _UPDATE_LEAD_STATUS,
+            {"target_id": user_id, "status": status}
+        )
+        if result.rowcount:
+            logger.info("lead_status_updated", user_id=user_id, status=status)
+
 
+# ===========================================
+# WRITE-BEHIND (fuera del camino crítico)
+# ===========================================
 
-async def update_user_lead_status(user_id: str, status: str):
+def _ensure_writer() -> asyncio.Queue:
+    """Crea la cola y arranca el writer en el primer uso (o si terminó)."""
+    global _write_queue, _writer_task
+    if _write_queue is None:
+        _write_queue = asyncio.Queue(maxsize=WRITE_BEHIND_QUEUE_SIZE)
+    if _writer_task is None or _writer_task.done():
+        _writer_task = asyncio.create_task(_run_writer(_write_queue))
+    return _write_queue
+
+
+async def enqueue_message(
+    conversation_id: str,
+    role: str,
+    content: str,
+    response_time_ms: int = None,
+    tokens_used: int = None,
+    model_used: str = None
+):
     """
-    Actualiza el estado del lead.
+    Encola un mensaje para guardarlo en el próximo lote, sin esperar a Postgres.
+    Si la cola está llena espera (backpressure) en vez de descartar.
     """
+    await _ensure_writer().put(("message", {
+        "conversation_id": conversation_id,
+        "role": role,
+        "content": content,
+        "response_time_ms": response_time_ms,
+        "tokens_used": tokens_used,
+        "model_used": model_used
+    }))
+
+
+async def enqueue_lead_status(user_id: str, status: str):
+    """Encola la actualización del estado del lead para el próximo lote."""
+    await _ensure_writer().put(("lead_status", (user_id, status)))
+
+
+async def _write_batch(batch: list):
+    """Escribe un lote en una transacción: un INSERT multi-fila y pocos UPDATE."""
+    messages = [payload for kind, payload in batch if kind == "message"]
+    # Si un usuario aparece varias veces, gana el último estado
+    lead_updates = dict(payload for kind, payload in batch if kind == "lead_status")
+    
     async with async_session_maker() as session:
-        query = select(User).where(User.id == user_id)
-        result = await session.execute(query)
-        user = result.scalar_one_or_none()
+        if messages:
+            await session.execute(insert(Message), messages)
+            conversation_ids = {m["conversation_id"] for m in messages}
+            await session.execute(
+                update(Conversation)
+                .where(Conversation.id.in_(conversation_ids))
+                .values(last_message_at=func.now())
+            )
+        if lead_updates:
+            # UPDATE por primary key en bloque (executemany)
+            await session.execute(
+                update(User),
+                [{"id": user_id, "lead_status": status} for user_id, status in lead_updates.items()]
+            )
+        await session.commit()
+    
+    logger.info("write_behind_flushed", messages=len(messages), lead_updates=len(lead_updates))
+
+
+async def _write_with_fallback(batch: list):
+    """
+    Escribe un lote; si falla lo reintenta una vez y, si vuelve a fallar,
+    escribe fila por fila: una fila inválida (p. ej. una conversación
+    borrada) no arrastra los mensajes y leads del resto del lote.
+    """
+    try:
+        await _write_batch(batch)
+        return
+    except Exception as e:
+        logger.warning("write_behind_batch_failed", error=str(e), items=len(batch))
+    
+    await asyncio.sleep(WRITE_BEHIND_RETRY_DELAY)
+    try:
+        await _write_batch(batch)
+        return
+    except Exception as e:
+        logger.warning("write_behind_retry_failed", error=str(e), items=len(batch))
+    
+    failed = 0
+    for item in batch:
+        try:
+            await _write_batch([item])
+        except Exception as e:
+            failed += 1
+            logger.error("write_behind_error", error=str(e), kind=item[0])
+    logger.info("write_behind_row_by_row", items=len(batch), failed=failed)
+
+
+async def _run_writer(queue: asyncio.Queue):
+    """Junta lo encolado durante WRITE_BEHIND_INTERVAL y lo escribe en un lote."""
+    while True:
+        batch = [await queue.get()]
+        await asyncio.sleep(WRITE_BEHIND_INTERVAL)
+        while len(batch) < WRITE_BEHIND_MAX_BATCH and not queue.empty():
+            batch.append(queue.get_nowait())
         
-        if user:
-            user.lead_status = status
-            user.updated_at = datetime.utcnow()
-            await session.commit()
-            logger.info("lead_status_updated", user_id=user_id, status=status)
\ No newline at end of file
+        try:
+            await _write_with_fallback(batch)
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+
+async def flush_write_behind():
+    """Espera a que se escriba todo lo encolado y detiene el writer (al apagar)."""
+    global _writer_task
+    if _write_queue is not None and _writer_task is not None and not _writer_task.done():
+        await _write_queue.join()
+    if _writer_task is not None:
+        _writer_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await _writer_task
+        _writer_task = None
@@ -4,16 +4,23 @@ Servicio de Feedback - Gestiona calificaciones y métricas.
 Permite aprender de las interacciones y mejorar el sistema.
 """
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta, timezone
 from typing import Optional, List
-from sqlalchemy import select, func, and_
+from sqlalchemy import select, func, and_, cast, Date
+from sqlalchemy.dialects.postgresql import insert
+import asyncio
 import structlog
 
 from app.core.database import async_session_maker
-from app.models import Message, Conversation, User, Feedback
+from app.models import Message, Conversation, User, Feedback, DailyMetrics
 
 logger = structlog.get_logger()
 
+# Días que se recalculan al arrancar y en cada corrida periódica del rollup
+METRICS_BACKFILL_DAYS = 90
+METRICS_REFRESH_DAYS = 2
+METRICS_REFRESH_INTERVAL = 3600
+
 
 async def save_feedback(
     message_id: str,
@@ -41,8 +48,7 @@ async def save_feedback(
             rating=rating,
             feedback_type=feedback_type,
             comment=comment,
-            corrected_response=corrected_response,
-            created_at=datetime.utcnow()
+            corrected_response=corrected_response
         )
         session.add(feedback)
         await session.commit()
@@ -62,76 +68,230 @@ async def save_feedback(
         }
 
 
+def _utc_day_start(day: date) -> datetime:
+    return datetime.combine(day, time.min, tzinfo=timezone.utc)
+
+
+def _utc_day(column):
+    """Día UTC de una columna timestamptz (independiente del TimeZone de la sesión)."""
+    return cast(func.timezone("UTC", column), Date)
+
+
+_ASSISTANT_TIMED = and_(Message.role == "assistant", Message.response_time_ms.isnot(None))
+
+
+async def refresh_daily_metrics(days: int = METRICS_REFRESH_DAYS):
+    """
+    Recalcula el rollup de los últimos `days` días completos (UTC) para todas
+    las empresas con INSERT ... SELECT ... ON CONFLICT DO UPDATE.
+    El día en curso no se guarda: get_conversation_metrics lo calcula en vivo.
+    """
+    today = datetime.now(timezone.utc).date()
+    since = _utc_day_start(today - timedelta(days=days))
+    until = _utc_day_start(today)
+    
+    conv_day = _utc_day(Conversation.started_at)
+    conv_select = select(
+        User.company_id,
+        conv_day,
+        func.count(Conversation.id)
+    ).join(
+        User, Conversation.user_id == User.id
+    ).where(
+        and_(Conversation.started_at >= since, Conversation.started_at < until)
+    ).group_by(User.company_id, conv_day)
+    
+    conv_stmt = insert(DailyMetrics).from_select(
+        ["company_id", "day", "conversations"], conv_select
+    )
+    conv_stmt = conv_stmt.on_conflict_do_update(
+        index_elements=["company_id", "day"],
+        set_={"conversations": conv_stmt.excluded.conversations, "updated_at": func.now()}
+    )
+    
+    msg_day = _utc_day(Message.created_at)
+    msg_select = select(
+        User.company_id,
+        msg_day,
+        func.count(Message.id),
+        func.coalesce(func.sum(Message.response_time_ms).filter(_ASSISTANT_TIMED), 0),
+        func.count(Message.id).filter(_ASSISTANT_TIMED)
+    ).join(
+        Conversation, Message.conversation_id == Conversation.id
+    ).join(
+        User, Conversation.user_id == User.id
+    ).where(
+        and_(Message.created_at >= since, Message.created_at < until)
+    ).group_by(User.company_id, msg_day)
+    
+    msg_stmt = insert(DailyMetrics).from_select(
+        ["company_id", "day", "messages", "total_response_ms", "response_count"], msg_select
+    )
+    msg_stmt = msg_stmt.on_conflict_do_update(
+        index_elements=["company_id", "day"],
+        set_={
+            "messages": msg_stmt.excluded.messages,
+            "total_response_ms": msg_stmt.excluded.total_response_ms,
+            "response_count": msg_stmt.excluded.response_count,
+            "updated_at": func.now()
+        }
+    )
+    
+    async with async_session_maker() as session:
+        await session.execute(conv_stmt)
+        await session.execute(msg_stmt)
+        await session.commit()
+    
+    logger.info("daily_metrics_refreshed", days=days)
+
+
+async def run_daily_metrics_loop():
+    """
+    Backfill al arrancar y luego refresco periódico del rollup.
+    Se usa cuando no hay worker de arq (sin REDIS_URL); con worker lo hace su cron.
+    """
+    days = METRICS_BACKFILL_DAYS
+    while True:
+        try:
+            await refresh_daily_metrics(days)
+            days = METRICS_REFRESH_DAYS
+        except Exception as e:
+            logger.error("daily_metrics_refresh_error", error=str(e))
+        await asyncio.sleep(METRICS_REFRESH_INTERVAL)
+
+
+async def _fetch_one(query):
+    """Ejecuta una consulta agregada en una sesión propia y retorna su única fila."""
+    async with async_session_maker() as session:
+        result = await session.execute(query)
+        return result.one()
+
+
+async def _rollup_covered_until(company_id: str) -> Optional[date]:
+    """
+    Primer día (UTC) que el rollup de la empresa todavía no cubre: cada
+    refresco guarda los días completos anteriores al día en que corrió, y
+    nunca más allá del día siguiente a su última fila (un refresco que
+    cruza la medianoche no da por cubierto el día que no alcanzó a guardar).
+    None si la empresa no tiene filas en el rollup.
+    """
+    updated_at, last_day = await _fetch_one(
+        select(
+            func.max(DailyMetrics.updated_at),
+            func.max(DailyMetrics.day)
+        ).where(DailyMetrics.company_id == company_id)
+    )
+    return _covered_until(updated_at, last_day)
+
+
+def _covered_until(updated_at: Optional[datetime], last_day: Optional[date]) -> Optional[date]:
+    """Cálculo de _rollup_covered_until a partir de las filas del rollup."""
+    if updated_at is None:
+        return None
+    return min(updated_at.astimezone(timezone.utc).date(), last_day + timedelta(days=1))
+
+
+def _metrics_window(today: date, days: int, covered_until: Optional[date]) -> tuple:
+    """
+    Límites de la ventana de métricas: (window_start, rollup_until).
+    Los días [window_start, rollup_until) salen del rollup y desde
+    rollup_until hasta hoy se cuenta en vivo; hoy siempre es en vivo.
+    """
+    window_start = today - timedelta(days=days - 1)
+    rollup_until = min(max(covered_until or window_start, window_start), today)
+    return window_start, rollup_until
+
+
 async def get_conversation_metrics(
     company_id: str,
     days: int = 7
 ) -> dict:
     """
-    Obtiene métricas de conversaciones para una empresa.
+    Obtiene métricas de conversaciones para una empresa (los últimos `days`
+    días UTC, incluido el de hoy).
+    Los días ya guardados en el rollup daily_metrics salen de ahí; el resto
+    (hoy y, pasada la medianoche y antes del próximo refresco, también ayer)
+    se cuenta en vivo sobre conversations/messages.
     """
-    async with async_session_maker() as session:
-        cutoff = datetime.utcnow() - timedelta(days=days)
-        
-        # Contar conversaciones
-        conv_query = select(func.count(Conversation.id)).join(
-            User, Conversation.user_id == User.id
-        ).where(
-            and_(
-                User.company_id == company_id,
-                Conversation.started_at >= cutoff
-            )
+    today = datetime.now(timezone.utc).date()
+    covered_until = await _rollup_covered_until(company_id)
+    window_start, rollup_until = _metrics_window(today, days, covered_until)
+    live_start = _utc_day_start(rollup_until)
+    
+    # Días cubiertos por el rollup: suma de sus filas
+    rollup_query = select(
+        func.coalesce(func.sum(DailyMetrics.conversations), 0),
+        func.coalesce(func.sum(DailyMetrics.messages), 0),
+        func.coalesce(func.sum(DailyMetrics.total_response_ms), 0),
+        func.coalesce(func.sum(DailyMetrics.response_count), 0)
+    ).where(
+        and_(
+            DailyMetrics.company_id == company_id,
+            DailyMetrics.day >= window_start,
+            DailyMetrics.day < rollup_until
         )
-        conv_result = await session.execute(conv_query)
-        total_conversations = conv_result.scalar() or 0
-        
-        # Contar mensajes
-        msg_query = select(func.count(Message.id)).join(
-            Conversation, Message.conversation_id == Conversation.id
-        ).join(
-            User, Conversation.user_id == User.id
-        ).where(
-            and_(
-                User.company_id == company_id,
-                Message.created_at >= cutoff
-            )
+    )
+    
+    # Días sin rollup: conversaciones en vivo
+    conv_query = select(func.count(Conversation.id)).join(
+        User, Conversation.user_id == User.id
+    ).where(
+        and_(
+            User.company_id == company_id,
+            Conversation.started_at >= live_start
         )
-        msg_result = await session.execute(msg_query)
-        total_messages = msg_result.scalar() or 0
-        
-        # Promedio de tiempo de respuesta
-        time_query = select(func.avg(Message.response_time_ms)).join(
-            Conversation, Message.conversation_id == Conversation.id
-        ).join(
-            User, Conversation.user_id == User.id
-        ).where(
-            and_(
-                User.company_id == company_id,
-                Message.created_at >= cutoff,
-                Message.role == "assistant",
-                Message.response_time_ms.isnot(None)
-            )
+    )
+    
+    # Días sin rollup: mensajes y tiempos de respuesta en una sola consulta
+    msg_query = select(
+        func.count(Message.id),
+        func.coalesce(func.sum(Message.response_time_ms).filter(_ASSISTANT_TIMED), 0),
+        func.count(Message.id).filter(_ASSISTANT_TIMED)
+    ).join(
+        Conversation, Message.conversation_id == Conversation.id
+    ).join(
+        User, Conversation.user_id == User.id
+    ).where(
+        and_(
+            User.company_id == company_id,
+            Message.created_at >= live_start
         )
-        time_result = await session.execute(time_query)
-        avg_response_time = time_result.scalar() or 0
-        
-        # Contar usuarios únicos
-        user_query = select(func.count(func.distinct(User.id))).where(
-            and_(
-                User.company_id == company_id,
-                User.last_interaction >= cutoff
-            )
+    )
+    
+    # Usuarios únicos: no es sumable por día, se cuenta en vivo sobre users
+    user_query = select(func.count(func.distinct(User.id))).where(
+        and_(
+            User.company_id == company_id,
+            User.last_interaction >= func.now() - timedelta(days=days)
         )
-        user_result = await session.execute(user_query)
-        unique_users = user_result.scalar() or 0
-        
-        return {
-            "period_days": days,
-            "total_conversations": total_conversations,
-            "total_messages": total_messages,
-            "unique_users": unique_users,
-            "avg_response_time_ms": round(avg_response_time, 2) if avg_response_time else 0,
-            "messages_per_conversation": round(total_messages / max(total_conversations, 1), 2)
-        }
+    )
+    
+    # Consultas independientes: cada una en su propia conexión del pool
+    rollup_row, conv_row, msg_row, user_row = await asyncio.gather(
+        _fetch_one(rollup_query),
+        _fetch_one(conv_query),
+        _fetch_one(msg_query),
+        _fetch_one(user_query)
+    )
+    
+    total_conversations, total_messages, total_response_ms, response_count = rollup_row
+    live_messages, live_response_ms, live_response_count = msg_row
+    total_conversations += conv_row[0] or 0
+    total_messages += live_messages
+    total_response_ms += live_response_ms
+    response_count += live_response_count
+    unique_users = user_row[0] or 0
+    
+    avg_response_time = total_response_ms / response_count if response_count else 0
+    
+    return {
+        "period_days": days,
+        "total_conversations": total_conversations,
+        "total_messages": total_messages,
+        "unique_users": unique_users,
+        "avg_response_time_ms": round(avg_response_time, 2) if avg_response_time else 0,
+        "messages_per_conversation": round(total_messages / max(total_conversations, 1), 2)
+    }
 
 
 async def get_lead_funnel(company_id: str) -> dict:
@@ -213,16 +373,26 @@ async def get_low_rated_responses(
         ]
 
 
+# Palabras que indican que el usuario pidió escalar
+ESCALATION_KEYWORDS = ("humano", "persona", "asesor", "queja", "supervisor")
+_ESCALATION_PATTERN = f"({'|'.join(ESCALATION_KEYWORDS)})"
+
+
 async def detect_escalation_patterns(company_id: str) -> dict:
     """
     Detecta patrones que llevan a escalación.
+    Total y mensajes con palabras de escalación salen de una sola consulta:
+    un COUNT con FILTER sobre una regex combinada (~*), apoyada por el
+    índice trigram de messages.content.
     """
     async with async_session_maker() as session:
-        # Buscar conversaciones escaladas
-        escalation_keywords = ["humano", "persona", "asesor", "queja", "supervisor"]
-        
         # Esto es simplificado - en producción usarías análisis más sofisticado
-        query = select(func.count(Message.id)).join(
+        query = select(
+            func.count(Message.id),
+            func.count(Message.id).filter(
+                Message.content.regexp_match(_ESCALATION_PATTERN, flags="i")
+            )
+        ).join(
             Conversation, Message.conversation_id == Conversation.id
         ).join(
             User, Conversation.user_id == User.id
@@ -234,25 +404,7 @@ async def detect_escalation_patterns(company_id: str) -> dict:
         )
         
         result = await session.execute(query)
-        total_user_messages = result.scalar() or 0
-        
-        # Contar mensajes con palabras de escalación
-        escalation_count = 0
-        if total_user_messages > 0:
-            for keyword in escalation_keywords:
-                kw_query = select(func.count(Message.id)).join(
-                    Conversation, Message.conversation_id == Conversation.id
-                ).join(
-                    User, Conversation.user_id == User.id
-                ).where(
-                    and_(
-                        User.company_id == company_id,
-                        Message.role == "user",
-                        Message.content.ilike(f"%{keyword}%")
-                    )
-                )
-                kw_result = await session.execute(kw_query)
-                escalation_count += kw_result.scalar() or 0
+        total_user_messages, escalation_count = result.one()
         
         escalation_rate = round(escalation_count / max(total_user_messages, 1) * 100, 2)
         
@@ -261,4 +413,4 @@ async def detect_escalation_patterns(company_id: str) -> dict:
             "escalation_requests": escalation_count,
             "escalation_rate_percent": escalation_rate,
             "status": "healthy" if escalation_rate < 10 else "needs_attention"
-        }
\ No newline at end of file
+        }
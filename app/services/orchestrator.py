@@ -2,18 +2,22 @@
 Orquestador - Coordina el procesamiento de mensajes con memoria y RAG.
 """
 
-from datetime import datetime
+import asyncio
 import time
 import structlog
 
 from app.schemas.message import NormalizedMessage, AgentResponse
-from app.services.ai_service import generate_ai_response
+from app.services.ai_service import generate_ai_response, get_rag_context
+from app.core.database import async_session_maker
+from app.core.history_cache import append_history
 from app.services.database_service import (
     get_or_create_user,
     get_or_create_conversation,
     save_message,
     get_conversation_history,
-    update_user_lead_status
+    get_company_config,
+    enqueue_message,
+    enqueue_lead_status
 )
 
 logger = structlog.get_logger()
@@ -33,53 +37,72 @@ async def process_message(message: NormalizedMessage) -> AgentResponse:
         message_preview=message.message[:50]
     )
     
+    # RAG especulativo: la búsqueda solo depende del mensaje, arranca de inmediato
+    rag_task = asyncio.create_task(get_rag_context(message.company_id, message.message))
+    
     try:
-        # 1. Obtener o crear usuario
-        user = await get_or_create_user(
-            company_id=message.company_id,
-            channel=message.channel,
-            channel_user_id=message.user_id
-        )
+        # Turno del usuario: una sola sesión y una transacción para
+        # usuario, conversación, mensaje e historial
+        async with async_session_maker() as session:
+            # 1. Obtener o crear usuario
+            user = await get_or_create_user(
+                company_id=message.company_id,
+                channel=message.channel,
+                channel_user_id=message.user_id,
+                session=session
+            )
+            
+            # 2. Obtener o crear conversación
+            conversation_id = await get_or_create_conversation(
+                user_id=user.id,
+                channel=message.channel,
+                session=session
+            )
+            
+            # 3. Historial previo (Redis o esta sesión) y configuración, en paralelo con el RAG en curso.
+            # Se lee antes de guardar el mensaje actual, así no hay que quitarlo del historial.
+            history, config, rag_context = await asyncio.gather(
+                get_conversation_history(
+                    conversation_id=conversation_id,
+                    limit=10,
+                    session=session
+                ),
+                get_company_config(message.company_id),
+                rag_task
+            )
+            
+            # 4. Guardar mensaje del usuario
+            await save_message(
+                conversation_id=conversation_id,
+                role="user",
+                content=message.message,
+                session=session
+            )
+            
+            # Commit antes de llamar a la IA: no retener la conexión durante el LLM
+            await session.commit()
         
-        # 2. Obtener o crear conversación
-        conversation = await get_or_create_conversation(
-            user_id=user.id,
-            channel=message.channel
-        )
-        
-        # 3. Guardar mensaje del usuario
-        await save_message(
-            conversation_id=conversation.id,
-            role="user",
-            content=message.message
-        )
-        
-        # 4. Obtener historial de conversación
-        history = await get_conversation_history(
-            conversation_id=conversation.id,
-            limit=10
-        )
-        
-        # Remover el último mensaje (el actual) del historial
-        if history and history[-1]["content"] == message.message:
-            history = history[:-1]
+        await append_history(conversation_id, "user", message.message)
         
         logger.info("conversation_context", history_length=len(history))
         
-        # 5. Generar respuesta con IA + RAG
+        # 5. Generar respuesta con IA + RAG (con cache si no hay historial)
         response = await generate_ai_response(
             user_message=message.message,
             conversation_history=history,
             company_name="nuestra empresa",
-            company_id=message.company_id  # Para RAG
+            company_id=message.company_id,
+            escalation_keywords=config.escalation_keywords if config else None,
+            rag_context=rag_context
         )
         
         # Calcular tiempo de respuesta
         response_time_ms = int((time.time() - start_time) * 1000)
         
+        # Turno del asistente: write-behind, la respuesta no espera a Postgres
         # 6. Guardar respuesta del asistente
-        await save_message(
-            conversation_id=conversation.id,
+        await enqueue_message(
+            conversation_id=conversation_id,
             role="assistant",
             content=response.message,
             response_time_ms=response_time_ms
@@ -87,7 +110,9 @@ async def process_message(message: NormalizedMessage) -> AgentResponse:
         
         # 7. Actualizar estado del lead si cambió
         if response.lead_status:
-            await update_user_lead_status(user.id, response.lead_status)
+            await enqueue_lead_status(user.id, response.lead_status)
+        
+        await append_history(conversation_id, "assistant", response.message)
         
         logger.info(
             "response_generated",
@@ -97,9 +122,10 @@ async def process_message(message: NormalizedMessage) -> AgentResponse:
         )
         
         return response
-        
+    
     except Exception as e:
         logger.error("process_message_error", error=str(e))
+        rag_task.cancel()
         
         return AgentResponse(
             message="Disculpa, tuve un problema. ¿Podrías intentar de nuevo?",
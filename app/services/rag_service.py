@@ -4,28 +4,95 @@ Servicio RAG - Retrieval Augmented Generation con Qdrant.
 Permite que el agente responda usando documentos de la empresa.
 """
 
-import openai
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient
 from qdrant_client.http import models
-from typing import List
+from typing import Awaitable, Callable, List, Optional
+import asyncio
 import structlog
 import hashlib
+import re
 
+from cachetools import TTLCache
+import numpy as np
+
+from app.core.cache_invalidation import invalidate_company_caches, register_invalidation_handler
 from app.core.config import settings
+from app.core.openai_client import client
+from app.core.embedding_cache import get_cached_embedding, set_cached_embedding, set_cached_embeddings
+from app.core.llm_cache import SemanticCache
 
 logger = structlog.get_logger()
 
-# Cliente de OpenAI para embeddings
-openai_client = openai.AsyncOpenAI(api_key=settings.openai_api_key)
+# Cliente de OpenAI compartido, con los reintentos por defecto del SDK para embeddings
+openai_client = client.with_options(max_retries=2)
 
-# Cliente de Qdrant
-qdrant_client = QdrantClient(
+# Cliente async de Qdrant (compartido con main): las búsquedas no bloquean el event loop
+qdrant_client = AsyncQdrantClient(
     host=settings.qdrant_host,
-    port=settings.qdrant_port
+    port=settings.qdrant_port,
+    grpc_port=settings.qdrant_grpc_port,
+    prefer_grpc=True
+)
+
+# Dimensión de los embeddings: la misma al cargar documentos y al consultar
+EMBEDDING_DIMENSION = settings.openai_embedding_dimensions
+
+# Cuantización int8 en RAM: la búsqueda HNSW recorre vectores de 1 byte por
+# dimensión y reordena los candidatos con los vectores originales
+QUANTIZATION_OVERSAMPLING = 2.0
+
+# Textos por request de embeddings al cargar documentos en lote, y lotes
+# procesados a la vez (acota la presión sobre el rate limit de OpenAI)
+EMBEDDING_BATCH_SIZE = 96
+INGEST_MAX_CONCURRENCY = 16
+
+# Segundos de espera antes de duplicar un request de embedding lento (hedging)
+EMBEDDING_HEDGE_DELAY = 0.3
+
+# Cache de contexto RAG por (empresa, consulta normalizada): evita embedding +
+# búsqueda en Qdrant para consultas repetidas ("precios", "horario")
+RAG_CONTEXT_CACHE_TTL = 300
+_context_cache: TTLCache = TTLCache(maxsize=4096, ttl=RAG_CONTEXT_CACHE_TTL)
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+
+# Cache semántico de contexto: paráfrasis de una consulta ya buscada
+# ("horarios" ~ "horario de atención") reutilizan su contexto sin ir a Qdrant
+RAG_SEMANTIC_THRESHOLD = 0.92
+RAG_SEMANTIC_PER_COMPANY = 1024
+_semantic_context_cache = SemanticCache(
+    threshold=RAG_SEMANTIC_THRESHOLD,
+    max_per_company=RAG_SEMANTIC_PER_COMPANY,
+    ttl=RAG_CONTEXT_CACHE_TTL
 )
 
-# Dimensión de embeddings de OpenAI text-embedding-3-small
-EMBEDDING_DIMENSION = 1536
+# Colecciones que este proceso ya verificó o creó, y cantidad de puntos
+# por colección: la búsqueda no consulta a Qdrant por la colección en
+# cada request. Aquí solo se cachean tamaños > 0
+COLLECTION_SIZE_TTL = 300
+_known_collections: set = set()
+_collection_sizes: TTLCache = TTLCache(maxsize=4096, ttl=COLLECTION_SIZE_TTL)
+
+# Colecciones inexistentes o vacías, por poco tiempo: una empresa sin base de
+# conocimiento no paga un embedding ni una consulta a Qdrant por mensaje. Los
+# documentos nuevos se ven de inmediato en este proceso (invalidate_context_cache)
+# y en los demás al llegar el aviso por Redis (cache_invalidation), o a los
+# EMPTY_COLLECTION_TTL segundos si se pierde
+EMPTY_COLLECTION_TTL = 30
+_empty_collections: TTLCache = TTLCache(maxsize=4096, ttl=EMPTY_COLLECTION_TTL)
+
+# Parámetros HNSW por tamaño de colección: (hasta N puntos, m, ef_construct, ef de búsqueda)
+HNSW_TIERS = (
+    (100_000, 16, 64, 40),
+    (1_000_000, 24, 100, 100),
+    (None, 32, 128, 200),
+)
+
+
+def configure_hnsw_params(points_count: int) -> tuple:
+    """Retorna (m, ef_construct, ef) para una colección de points_count puntos."""
+    for limit, m, ef_construct, ef in HNSW_TIERS:
+        if limit is None or points_count < limit:
+            return m, ef_construct, ef
 
 
 def get_collection_name(company_id: str) -> str:
@@ -34,24 +101,69 @@ def get_collection_name(company_id: str) -> str:
 
 
 def generate_numeric_id(content: str) -> int:
-    """Genera un ID numérico único basado en el contenido."""
-    hash_hex = hashlib.md5(content.encode()).hexdigest()
-    return int(hash_hex[:15], 16)
+    """
+    Genera un ID numérico único basado en el contenido.
+    BLAKE2b de 8 bytes leído directo como entero (sin pasar por hex),
+    recortado a 63 bits para que quepa en un entero con signo.
+    """
+    digest = hashlib.blake2b(content.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & ((1 << 63) - 1)
 
 
-async def create_embedding(text: str) -> List[float]:
+async def _hedged(request: Callable[[], Awaitable], delay: float):
     """
-    Crea embedding de un texto usando OpenAI.
+    Lanza request(); si no terminó en `delay` segundos lanza un duplicado
+    y retorna el primero que responda bien. El otro se cancela.
     """
+    tasks = [asyncio.create_task(request())]
     try:
-        response = await openai_client.embeddings.create(
-            model=settings.openai_embedding_model,
-            input=text
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            logger.info("request_hedged", delay=delay)
+            tasks.append(asyncio.create_task(request()))
+        
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def create_embedding(text: str) -> np.ndarray:
+    """
+    Crea embedding de un texto usando OpenAI, como vector float32 contiguo
+    (la lista de floats del SDK se convierte una sola vez, aquí).
+    Los embeddings se cachean por modelo y texto (en memoria y en Redis,
+    ver app.core.embedding_cache), y el request a OpenAI se duplica si
+    tarda más de EMBEDDING_HEDGE_DELAY.
+    """
+    cached = await get_cached_embedding(text)
+    if cached is not None:
+        return cached
+    
+    try:
+        response = await _hedged(
+            lambda: openai_client.embeddings.create(
+                model=settings.openai_embedding_model,
+                input=text,
+                dimensions=EMBEDDING_DIMENSION
+            ),
+            EMBEDDING_HEDGE_DELAY
         )
-        return response.data[0].embedding
+        embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
     except Exception as e:
         logger.error("embedding_error", error=str(e))
         raise
+    
+    await set_cached_embedding(text, embedding)
+    return embedding
 
 
 async def ensure_collection_exists(company_id: str):
@@ -59,27 +171,174 @@ async def ensure_collection_exists(company_id: str):
     Asegura que existe la colección de Qdrant para una empresa.
     """
     collection_name = get_collection_name(company_id)
+    if collection_name in _known_collections:
+        return collection_name
     
     try:
-        collections = qdrant_client.get_collections()
-        exists = any(c.name == collection_name for c in collections.collections)
-        
-        if not exists:
-            qdrant_client.create_collection(
+        if not await qdrant_client.collection_exists(collection_name):
+            # Una colección nueva arranca en el tier más chico
+            m, ef_construct, _ = configure_hnsw_params(0)
+            await qdrant_client.create_collection(
                 collection_name=collection_name,
                 vectors_config=models.VectorParams(
                     size=EMBEDDING_DIMENSION,
-                    distance=models.Distance.COSINE
-                )
+                    distance=models.Distance.COSINE,
+                    datatype=models.Datatype.FLOAT16,
+                    on_disk=True
+                ),
+                hnsw_config=models.HnswConfigDiff(m=m, ef_construct=ef_construct),
+                quantization_config=models.ScalarQuantization(
+                    scalar=models.ScalarQuantizationConfig(
+                        type=models.ScalarType.INT8,
+                        always_ram=True
+                    )
+                ),
+                # El texto de los documentos vive en disco (mmap); la RAM queda para el grafo HNSW
+                on_disk_payload=True
             )
             logger.info("collection_created", collection=collection_name)
         
+        _known_collections.add(collection_name)
         return collection_name
     except Exception as e:
         logger.error("collection_error", error=str(e))
         raise
 
 
+async def create_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    Crea los embeddings de varios textos en un solo request a OpenAI.
+    Los resultados también quedan en el cache de create_embedding.
+    """
+    try:
+        response = await openai_client.embeddings.create(
+            model=settings.openai_embedding_model,
+            input=texts,
+            dimensions=EMBEDDING_DIMENSION
+        )
+    except Exception as e:
+        logger.error("embedding_error", error=str(e), batch_size=len(texts))
+        raise
+    
+    embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    await set_cached_embeddings(texts, embeddings)
+    return embeddings
+
+
+async def _upsert_points(
+    collection_name: str,
+    company_id: str,
+    contents: List[str],
+    embeddings: list,
+    metadatas: List[Optional[dict]],
+    doc_ids: List[int]
+):
+    """Un upsert en Qdrant con los documentos y sus embeddings ya calculados."""
+    points = [
+        models.PointStruct(
+            id=doc_id,
+            vector=embedding,
+            payload={
+                "content": content,
+                "company_id": company_id,
+                **(metadata or {})
+            }
+        )
+        for content, embedding, metadata, doc_id in zip(contents, embeddings, metadatas, doc_ids)
+    ]
+    
+    await qdrant_client.upsert(collection_name=collection_name, points=points)
+
+
+async def add_documents(
+    company_id: str,
+    contents: List[str],
+    metadatas: Optional[List[dict]] = None,
+    doc_ids: Optional[List[int]] = None,
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    max_concurrency: int = INGEST_MAX_CONCURRENCY
+) -> List[int]:
+    """
+    Agrega varios documentos a la base de conocimiento de una empresa.
+    Por cada lote de batch_size documentos: un request de embeddings
+    y un solo upsert en Qdrant. Hasta max_concurrency lotes en paralelo.
+    """
+    collection_name = await ensure_collection_exists(company_id)
+    
+    metadatas = metadatas or [None] * len(contents)
+    doc_ids = doc_ids or [None] * len(contents)
+    doc_ids = [
+        doc_id if doc_id is not None else generate_numeric_id(content)
+        for content, doc_id in zip(contents, doc_ids)
+    ]
+    
+    logger.info("adding_documents", company_id=company_id, count=len(contents))
+    
+    semaphore = asyncio.Semaphore(max_concurrency)
+    
+    async def add_batch(start: int):
+        async with semaphore:
+            batch = contents[start:start + batch_size]
+            embeddings = await create_embeddings(batch)
+            await _upsert_points(
+                collection_name,
+                company_id,
+                batch,
+                embeddings,
+                metadatas[start:start + batch_size],
+                doc_ids[start:start + batch_size]
+            )
+    
+    try:
+        await asyncio.gather(*(add_batch(start) for start in range(0, len(contents), batch_size)))
+    except Exception:
+        # Puede que otro proceso haya borrado la colección: volver a verificarla
+        forget_collection(company_id)
+        raise
+    
+    _collection_sizes.pop(collection_name, None)
+    invalidate_context_cache(company_id)
+    logger.info("documents_added", company_id=company_id, count=len(doc_ids))
+    return doc_ids
+
+
+async def add_embedded_documents(
+    company_id: str,
+    contents: List[str],
+    embeddings: list,
+    metadata: Optional[dict] = None,
+    batch_size: int = EMBEDDING_BATCH_SIZE
+) -> List[int]:
+    """
+    Agrega documentos cuyos embeddings ya se calcularon fuera de este
+    proceso (Batch API de OpenAI, ver batch_ai_service). Los IDs salen
+    del contenido, igual que en add_documents.
+    """
+    collection_name = await ensure_collection_exists(company_id)
+    doc_ids = [generate_numeric_id(content) for content in contents]
+    metadatas = [metadata] * len(contents)
+    
+    try:
+        for start in range(0, len(contents), batch_size):
+            end = start + batch_size
+            await _upsert_points(
+                collection_name,
+                company_id,
+                contents[start:end],
+                embeddings[start:end],
+                metadatas[start:end],
+                doc_ids[start:end]
+            )
+    except Exception:
+        forget_collection(company_id)
+        raise
+    
+    _collection_sizes.pop(collection_name, None)
+    invalidate_context_cache(company_id)
+    logger.info("documents_added", company_id=company_id, count=len(doc_ids))
+    return doc_ids
+
+
 async def add_document(
     company_id: str,
     content: str,
@@ -89,82 +348,137 @@ async def add_document(
     """
     Agrega un documento a la base de conocimiento de una empresa.
     """
-    collection_name = await ensure_collection_exists(company_id)
-    
-    if doc_id is None:
-        doc_id = generate_numeric_id(content)
-    
-    embedding = await create_embedding(content)
-    
     logger.info("adding_document", company_id=company_id, doc_id=doc_id, content_preview=content[:50])
     
-    payload = {
-        "content": content,
-        "company_id": company_id,
-        **(metadata or {})
-    }
-    
-    qdrant_client.upsert(
-        collection_name=collection_name,
-        points=[
-            models.PointStruct(
-                id=doc_id,
-                vector=embedding,
-                payload=payload
-            )
-        ]
+    doc_ids = await add_documents(
+        company_id,
+        [content],
+        [metadata],
+        [doc_id] if doc_id is not None else None
     )
+    return doc_ids[0]
+
+
+def forget_collection(company_id: str):
+    """Olvida lo cacheado de la colección de una empresa (p. ej. al borrarla)."""
+    collection_name = get_collection_name(company_id)
+    _known_collections.discard(collection_name)
+    _collection_sizes.pop(collection_name, None)
+    _empty_collections.pop(collection_name, None)
+
+
+def _cached_points_count(collection_name: str) -> Optional[int]:
+    """Cantidad de puntos cacheada (0 si no existe o está vacía), o None si no se sabe."""
+    points_count = _collection_sizes.get(collection_name)
+    if points_count is not None:
+        return points_count
+    if collection_name in _empty_collections:
+        return 0
+    return None
+
+
+async def _fetch_points_count(collection_name: str) -> Optional[int]:
+    """Consulta a Qdrant la cantidad de puntos, o None si la colección no existe."""
+    if collection_name not in _known_collections:
+        if not await qdrant_client.collection_exists(collection_name):
+            _empty_collections[collection_name] = True
+            return None
+        _known_collections.add(collection_name)
     
-    logger.info("document_added", company_id=company_id, doc_id=doc_id)
-    return doc_id
+    collection_info = await qdrant_client.get_collection(collection_name)
+    points_count = collection_info.points_count or 0
+    if points_count:
+        _collection_sizes[collection_name] = points_count
+    else:
+        _empty_collections[collection_name] = True
+    return points_count
 
 
 async def search_documents(
     company_id: str,
     query: str,
-    limit: int = 3
+    limit: int = 3,
+    query_embedding: Optional[np.ndarray] = None,
+    with_metadata: bool = True
 ) -> List[dict]:
     """
     Busca documentos relevantes para una consulta.
+    query_embedding: embedding de la consulta si el llamador ya lo tiene.
+    with_metadata: si es False solo se pide y retorna content y score.
+    
+    El embedding de la consulta se calcula en paralelo con la consulta
+    de la colección a Qdrant; con el tamaño de la colección en cache no
+    hay consulta previa. Una colección que se sabe vacía o inexistente
+    retorna [] sin calcular el embedding.
     """
     collection_name = get_collection_name(company_id)
+    points_count = _cached_points_count(collection_name)
+    if points_count == 0:
+        logger.debug("collection_empty_cached", company_id=company_id)
+        return []
+    
+    embedding_task = None
+    if query_embedding is None:
+        embedding_task = asyncio.create_task(create_embedding(query))
     
     try:
-        collections = qdrant_client.get_collections()
-        exists = any(c.name == collection_name for c in collections.collections)
+        if points_count is None:
+            points_count = await _fetch_points_count(collection_name)
         
-        logger.info("searching_documents", company_id=company_id, collection=collection_name, exists=exists)
+        logger.debug(
+            "searching_documents",
+            company_id=company_id,
+            collection=collection_name,
+            exists=points_count is not None,
+            points_count=points_count
+        )
         
-        if not exists:
+        if points_count is None:
             logger.info("no_collection_for_company", company_id=company_id)
             return []
         
-        collection_info = qdrant_client.get_collection(collection_name)
-        logger.info("collection_info", points_count=collection_info.points_count)
-        
-        if collection_info.points_count == 0:
+        if points_count == 0:
             logger.info("collection_empty", company_id=company_id)
             return []
         
-        query_embedding = await create_embedding(query)
+        if embedding_task is not None:
+            query_embedding = await embedding_task
+        
+        # ef de búsqueda según el tamaño actual de la colección
+        _, _, hnsw_ef = configure_hnsw_params(points_count)
+        search_params = models.SearchParams(
+            hnsw_ef=hnsw_ef,
+            quantization=models.QuantizationSearchParams(
+                rescore=True,
+                oversampling=QUANTIZATION_OVERSAMPLING
+            )
+        )
+        
+        # Sin metadata, Qdrant solo envía el campo content del payload
+        with_payload = True if with_metadata else ["content"]
         
         # Usar el método correcto según la versión de qdrant-client
         try:
             # Intentar con query_points (versiones más nuevas)
-            search_result = qdrant_client.query_points(
+            # Por gRPC el vector viaja como float32 empaquetado, sin pasar por JSON
+            search_result = await qdrant_client.query_points(
                 collection_name=collection_name,
                 query=query_embedding,
-                limit=limit
+                limit=limit,
+                search_params=search_params,
+                with_payload=with_payload
             )
             results = search_result.points
             logger.info("used_query_points_method")
         except AttributeError:
             try:
                 # Intentar con search (versiones intermedias)
-                results = qdrant_client.search(
+                results = await qdrant_client.search(
                     collection_name=collection_name,
                     query_vector=query_embedding,
-                    limit=limit
+                    limit=limit,
+                    search_params=search_params,
+                    with_payload=with_payload
                 )
                 logger.info("used_search_method")
             except AttributeError:
@@ -173,9 +487,13 @@ async def search_documents(
                 url = f"http://{settings.qdrant_host}:{settings.qdrant_port}/collections/{collection_name}/points/search"
                 async with httpx.AsyncClient() as client:
                     response = await client.post(url, json={
-                        "vector": query_embedding,
+                        "vector": query_embedding.tolist(),
                         "limit": limit,
-                        "with_payload": True
+                        "with_payload": with_payload,
+                        "params": {
+                            "hnsw_ef": hnsw_ef,
+                            "quantization": {"rescore": True, "oversampling": QUANTIZATION_OVERSAMPLING}
+                        }
                     })
                     data = response.json()
                     results = data.get("result", [])
@@ -187,21 +505,18 @@ async def search_documents(
         for result in results:
             # Manejar diferentes formatos de resultado
             if hasattr(result, 'payload'):
-                content = result.payload.get("content", "")
+                payload = result.payload or {}
                 score = result.score
-                meta = {k: v for k, v in result.payload.items() if k != "content"}
             elif isinstance(result, dict):
-                content = result.get("payload", {}).get("content", "")
+                payload = result.get("payload") or {}
                 score = result.get("score", 0)
-                meta = {k: v for k, v in result.get("payload", {}).items() if k != "content"}
             else:
                 continue
-                
-            documents.append({
-                "content": content,
-                "score": score,
-                "metadata": meta
-            })
+            
+            document = {"content": payload.get("content", ""), "score": score}
+            if with_metadata:
+                document["metadata"] = {k: v for k, v in payload.items() if k != "content"}
+            documents.append(document)
         
         logger.info(
             "documents_found",
@@ -211,10 +526,14 @@ async def search_documents(
         )
         
         return documents
-        
+    
     except Exception as e:
         logger.error("search_error", error=str(e))
+        forget_collection(company_id)
         return []
+    finally:
+        if embedding_task is not None:
+            embedding_task.cancel()
 
 
 async def delete_document(company_id: str, doc_id: int) -> bool:
@@ -224,10 +543,11 @@ async def delete_document(company_id: str, doc_id: int) -> bool:
     collection_name = get_collection_name(company_id)
     
     try:
-        qdrant_client.delete(
+        await qdrant_client.delete(
             collection_name=collection_name,
             points_selector=models.PointIdsList(points=[doc_id])
         )
+        await invalidate_company_caches(company_id)
         logger.info("document_deleted", company_id=company_id, doc_id=doc_id)
         return True
     except Exception as e:
@@ -235,18 +555,79 @@ async def delete_document(company_id: str, doc_id: int) -> bool:
         return False
 
 
+async def close_qdrant():
+    """Cierra el cliente de Qdrant."""
+    await qdrant_client.close()
+
+
+_CONTEXT_HEADER = "INFORMACIÓN RELEVANTE DE LA EMPRESA:"
+
+
+def _context_cache_key(company_id: str, query: str) -> tuple:
+    """Llave del cache: minúsculas, sin puntuación y espacios colapsados."""
+    normalized = " ".join(_PUNCTUATION_RE.sub(" ", query.lower()).split())
+    return company_id, hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+
+
+def invalidate_context_cache(company_id: str):
+    """Descarta el contexto cacheado de una empresa (al cambiar sus documentos)."""
+    for key in [k for k in _context_cache.keys() if k[0] == company_id]:
+        _context_cache.pop(key, None)
+    _semantic_context_cache.invalidate(company_id)
+    collection_name = get_collection_name(company_id)
+    _collection_sizes.pop(collection_name, None)
+    _empty_collections.pop(collection_name, None)
+
+
+# Con REDIS_URL las búsquedas corren también en el worker de arq: los cambios
+# de documentos hechos en la API le llegan por Redis
+register_invalidation_handler(invalidate_context_cache)
+
+
 async def get_context_for_query(company_id: str, query: str) -> str:
     """
     Obtiene contexto relevante para una consulta.
     Retorna texto formateado listo para incluir en el prompt.
+    Se cachea RAG_CONTEXT_CACHE_TTL segundos por empresa y consulta normalizada,
+    y por similitud del embedding con las consultas ya buscadas. Si la
+    empresa no tiene documentos retorna "" sin calcular el embedding.
     """
-    documents = await search_documents(company_id, query, limit=3)
+    key = _context_cache_key(company_id, query)
+    cached = _context_cache.get(key)
+    if cached is not None:
+        return cached
     
-    if not documents:
+    collection_name = get_collection_name(company_id)
+    points_count = _cached_points_count(collection_name)
+    if points_count is None:
+        points_count = await _fetch_points_count(collection_name)
+    if not points_count:
         return ""
     
-    context_parts = ["INFORMACIÓN RELEVANTE DE LA EMPRESA:"]
-    for i, doc in enumerate(documents, 1):
-        context_parts.append(f"\n[Documento {i}]\n{doc['content']}")
+    query_embedding = await create_embedding(query)
+    cached = _semantic_context_cache.get(company_id, query_embedding)
+    if cached is not None:
+        logger.info("rag_context_semantic_hit", company_id=company_id, query_preview=query[:50])
+        _context_cache[key] = cached
+        return cached
+    
+    documents = await search_documents(
+        company_id,
+        query,
+        limit=3,
+        query_embedding=query_embedding,
+        with_metadata=False
+    )
+    
+    # Sin resultados no se cachea: search_documents también retorna [] ante errores
+    if not documents:
+        return ""
     
-    return "\n".join(context_parts)
\ No newline at end of file
+    # Un solo join sobre una lista del tamaño exacto
+    context = "".join([
+        _CONTEXT_HEADER,
+        *(f"\n\n[Documento {i}]\n{doc['content']}" for i, doc in enumerate(documents, 1))
+    ])
+    _context_cache[key] = context
+    _semantic_context_cache.set(company_id, query_embedding, context)
+    return context
\ No newline at end of file
@@ -2,60 +2,267 @@
 Servicio de Voz - Text-to-Speech con ElevenLabs y Speech-to-Text con Whisper.
 """
 
-import openai
-import httpx
+import asyncio
 import structlog
-from typing import Optional
+from typing import AsyncIterator, Optional
 import base64
+import io
+import threading
+import wave
 
 from app.core.config import settings
+from app.core.openai_client import client
+from app.core.http import TWILIO_HTTP, ELEVENLABS_HTTP
+from app.core.tts_cache import (
+    tts_cache_key,
+    get_cached_audio,
+    set_cached_audio,
+    get_cached_data_url,
+    set_cached_data_url
+)
 
 logger = structlog.get_logger()
 
-# Cliente OpenAI para Whisper
-openai_client = openai.AsyncOpenAI(api_key=settings.openai_api_key)
+# Cliente de OpenAI compartido, con los reintentos por defecto del SDK para Whisper
+openai_client = client.with_options(max_retries=2)
 
+# Modelos locales de faster-whisper por nombre (se cargan en el primer uso).
+# Se cargan desde threads de to_thread: el lock evita cargar dos veces el mismo
+_whisper_models: dict = {}
+_whisper_models_lock = threading.Lock()
 
-async def speech_to_text(audio_url: str) -> Optional[str]:
+# Transcripciones en curso por URL de grabación
+_inflight_transcriptions: dict[str, asyncio.Task] = {}
+
+
+async def speech_to_text(audio_url: str, duration: Optional[float] = None) -> Optional[str]:
     """
     Convierte audio a texto usando OpenAI Whisper.
     
+    Las peticiones concurrentes para la misma grabación (p. ej. reintentos
+    del webhook de Twilio) comparten una sola transcripción.
+    
     Args:
         audio_url: URL del archivo de audio (de Twilio)
+        duration: duración en segundos (RecordingDuration de Twilio); con
+            WHISPER_BACKEND=hybrid los audios cortos se transcriben localmente
     
     Returns:
         Texto transcrito o None si falla
     """
+    task = _inflight_transcriptions.get(audio_url)
+    if task is None:
+        task = asyncio.create_task(_transcribe(audio_url, duration))
+        _inflight_transcriptions[audio_url] = task
+        task.add_done_callback(lambda _: _inflight_transcriptions.pop(audio_url, None))
+    
+    # shield: si un llamador se cancela, los demás siguen esperando el resultado
+    return await asyncio.shield(task)
+
+
+def _local_model_for(duration: Optional[float]) -> Optional[str]:
+    """Modelo local con el que transcribir, o None para usar la API de OpenAI."""
+    if settings.whisper_backend == "faster-whisper":
+        return settings.whisper_model
+    if (
+        settings.whisper_backend == "hybrid"
+        and duration is not None
+        and duration < settings.whisper_short_max_seconds
+    ):
+        return settings.whisper_short_model
+    return None
+
+
+async def _transcribe(audio_url: str, duration: Optional[float] = None) -> Optional[str]:
+    """Descarga la grabación de Twilio y la transcribe con Whisper."""
     try:
-        # Descargar audio de Twilio
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                audio_url,
-                auth=(settings.twilio_account_sid, settings.twilio_auth_token)
-            )
-            audio_data = response.content
+        # Descargar audio de Twilio en MP3: ~10x menos bytes que el WAV
+        # por defecto, tanto en la descarga como en la subida a Whisper.
+        # El cliente compartido ya trae la auth y reutiliza la conexión.
+        response = await TWILIO_HTTP.get(f"{audio_url}.mp3", timeout=30.0)
+        audio_data = response.content
         
-        # Crear archivo temporal en memoria
-        audio_file = ("audio.wav", audio_data, "audio/wav")
-        
-        # Transcribir con Whisper
-        transcript = await openai_client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file,
-            language="es"  # Detecta automáticamente, pero priorizamos español
-        )
-        
-        logger.info("speech_to_text_success", text_preview=transcript.text[:50])
-        return transcript.text
+        local_model = _local_model_for(duration)
+        if local_model is not None:
+            text = await asyncio.to_thread(_transcribe_local, audio_data, local_model)
+        else:
+            # Crear archivo temporal en memoria
+            audio_file = ("audio.mp3", audio_data, "audio/mpeg")
+            
+            # Transcribir con Whisper
+            transcript = await openai_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=audio_file,
+                language="es"  # Detecta automáticamente, pero priorizamos español
+            )
+            text = transcript.text
         
+        logger.info("speech_to_text_success", local_model=local_model, text_preview=text[:50])
+        return text
+    
     except Exception as e:
         logger.error("speech_to_text_error", error=str(e))
         return None
 
 
+def _get_whisper_model(model_name: str):
+    """
+    Carga cada modelo de faster-whisper una sola vez.
+    Usa int8 en CPU (AVX-VNNI) e int8_float16 en GPU.
+    """
+    model = _whisper_models.get(model_name)
+    if model is not None:
+        return model
+    
+    with _whisper_models_lock:
+        model = _whisper_models.get(model_name)
+        if model is None:
+            import ctranslate2
+            from faster_whisper import WhisperModel
+            
+            if ctranslate2.get_cuda_device_count() > 0:
+                device, compute_type = "cuda", "int8_float16"
+            else:
+                device, compute_type = "cpu", "int8"
+            
+            model = WhisperModel(model_name, device=device, compute_type=compute_type)
+            _whisper_models[model_name] = model
+            logger.info("whisper_model_loaded", model=model_name, device=device, compute_type=compute_type)
+    return model
+
+
+def _transcribe_local(audio_data: bytes, model_name: str) -> str:
+    """Transcribe con faster-whisper. Bloqueante: ejecutar en un thread."""
+    options = {"language": "es"}
+    if model_name == settings.whisper_short_model:
+        # Audios cortos: greedy y sin los silencios de los extremos
+        options.update(beam_size=1, vad_filter=True)
+    segments, _ = _get_whisper_model(model_name).transcribe(io.BytesIO(audio_data), **options)
+    return " ".join(segment.text.strip() for segment in segments)
+
+
+def _silence_wav(seconds: float = 1.0, sample_rate: int = 16000) -> bytes:
+    """Genera un WAV mono de silencio (para calentar el modelo)."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(b"\x00\x00" * int(seconds * sample_rate))
+    return buffer.getvalue()
+
+
+async def warmup_speech_to_text():
+    """
+    Carga el modelo local de Whisper y transcribe 1s de silencio,
+    para que la primera llamada real no pague la carga del modelo.
+    No hace nada con el backend de OpenAI.
+    """
+    if settings.whisper_backend == "faster-whisper":
+        model_name = settings.whisper_model
+    elif settings.whisper_backend == "hybrid":
+        model_name = settings.whisper_short_model
+    else:
+        return
+    await asyncio.to_thread(_transcribe_local, _silence_wav(), model_name)
+
+
+# ElevenLabs: endpoint de streaming, modelo y ajustes de voz
+TTS_MODEL_ID = "eleven_multilingual_v2"
+TTS_VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.75,
+    "style": 0.0,
+    "use_speaker_boost": True
+}
+# Latencia mínima al primer byte; 64 kbps alcanza para telefonía
+TTS_STREAM_PARAMS = {"optimize_streaming_latency": 3, "output_format": "mp3_44100_64"}
+
+
+def _tts_key(text: str, voice_id: Optional[str]) -> str:
+    return tts_cache_key(
+        voice_id or settings.elevenlabs_voice_id,
+        TTS_MODEL_ID,
+        TTS_VOICE_SETTINGS,
+        TTS_STREAM_PARAMS["output_format"],
+        text
+    )
+
+
+async def _tts_chunks(text: str, voice_id: Optional[str]) -> AsyncIterator[bytes]:
+    """Fragmentos MP3 del endpoint de streaming; los errores de red se propagan."""
+    voice_id = voice_id or settings.elevenlabs_voice_id
+    
+    url = f"/v1/text-to-speech/{voice_id}/stream"
+    
+    headers = {
+        "Accept": "audio/mpeg",
+        "Content-Type": "application/json",
+        "xi-api-key": settings.elevenlabs_api_key
+    }
+    
+    data = {
+        "text": text,
+        "model_id": TTS_MODEL_ID,
+        "voice_settings": TTS_VOICE_SETTINGS
+    }
+    
+    async with ELEVENLABS_HTTP.stream(
+        "POST", url, params=TTS_STREAM_PARAMS, json=data, headers=headers
+    ) as response:
+        if response.status_code != 200:
+            body = await response.aread()
+            logger.error(
+                "text_to_speech_error", 
+                status=response.status_code,
+                response=body.decode("utf-8", "replace")
+            )
+            return
+        
+        async for chunk in response.aiter_bytes():
+            yield chunk
+    
+    logger.info("text_to_speech_success", text_preview=text[:50])
+
+
+async def stream_text_to_speech(text: str, voice_id: str = None) -> AsyncIterator[bytes]:
+    """
+    Convierte texto a audio con el endpoint de streaming de ElevenLabs y
+    entrega los fragmentos MP3 a medida que llegan, sin esperar al audio
+    completo. Si falla, el stream termina donde falló.
+    
+    Un audio ya generado para la misma voz y texto sale del cache; uno
+    nuevo se cachea solo si el stream llegó completo.
+    """
+    if not settings.elevenlabs_api_key:
+        logger.warning("elevenlabs_not_configured")
+        return
+    
+    key = _tts_key(text, voice_id)
+    cached = await get_cached_audio(key)
+    if cached is not None:
+        logger.info("text_to_speech_cached", text_preview=text[:50])
+        yield cached
+        return
+    
+    audio = bytearray()
+    try:
+        async for chunk in _tts_chunks(text, voice_id):
+            audio += chunk
+            yield chunk
+    except Exception as e:
+        logger.error("text_to_speech_error", error=str(e))
+        return
+    
+    if audio:
+        await set_cached_audio(key, bytes(audio))
+
+
 async def text_to_speech(text: str, voice_id: str = None) -> Optional[bytes]:
     """
     Convierte texto a audio usando ElevenLabs.
+    Junta el stream completo; si se corta a la mitad retorna None.
+    El audio se cachea por voz, modelo, ajustes y texto.
     
     Args:
         text: Texto a convertir
@@ -68,45 +275,26 @@ async def text_to_speech(text: str, voice_id: str = None) -> Optional[bytes]:
         logger.warning("elevenlabs_not_configured")
         return None
     
-    voice_id = voice_id or settings.elevenlabs_voice_id
+    key = _tts_key(text, voice_id)
+    cached = await get_cached_audio(key)
+    if cached is not None:
+        logger.info("text_to_speech_cached", text_preview=text[:50])
+        return cached
     
+    audio = bytearray()
     try:
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
-        
-        headers = {
-            "Accept": "audio/mpeg",
-            "Content-Type": "application/json",
-            "xi-api-key": settings.elevenlabs_api_key
-        }
-        
-        data = {
-            "text": text,
-            "model_id": "eleven_multilingual_v2",
-            "voice_settings": {
-                "stability": 0.5,
-                "similarity_boost": 0.75,
-                "style": 0.0,
-                "use_speaker_boost": True
-            }
-        }
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=data, headers=headers)
-            
-            if response.status_code == 200:
-                logger.info("text_to_speech_success", text_preview=text[:50])
-                return response.content
-            else:
-                logger.error(
-                    "text_to_speech_error", 
-                    status=response.status_code,
-                    response=response.text
-                )
-                return None
-                
+        async for chunk in _tts_chunks(text, voice_id):
+            audio += chunk
     except Exception as e:
         logger.error("text_to_speech_error", error=str(e))
         return None
+    
+    if not audio:
+        return None
+    
+    audio = bytes(audio)
+    await set_cached_audio(key, audio)
+    return audio
 
 
 async def text_to_speech_url(text: str, voice_id: str = None) -> Optional[str]:
@@ -114,12 +302,19 @@ async def text_to_speech_url(text: str, voice_id: str = None) -> Optional[str]:
     Convierte texto a audio y retorna URL base64 para Twilio.
     
     Twilio puede reproducir audio desde una URL o desde datos base64.
+    El data URL de una frase repetida sale del cache sin volver a codificar.
     """
+    key = _tts_key(text, voice_id)
+    data_url = get_cached_data_url(key)
+    if data_url is not None:
+        return data_url
+    
     audio_bytes = await text_to_speech(text, voice_id)
     
     if audio_bytes:
         # Convertir a base64 data URL
-        b64_audio = base64.b64encode(audio_bytes).decode('utf-8')
-        return f"data:audio/mpeg;base64,{b64_audio}"
+        data_url = "data:audio/mpeg;base64," + base64.b64encode(audio_bytes).decode("ascii")
+        set_cached_data_url(key, data_url)
+        return data_url
     
     return None
\ No newline at end of file
@@ -0,0 +1,22 @@
+"""
+Utilidades para leer formularios de webhooks.
+"""
+
+from urllib.parse import parse_qsl
+
+from fastapi import Request
+
+
+async def fast_form(request: Request):
+    """
+    Lee el formulario de un webhook.
+    
+    Twilio envía application/x-www-form-urlencoded pequeño; parse_qsl sobre
+    el body evita el parser genérico de Starlette (FormData, UploadFile).
+    Para otros content-types se usa request.form().
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        body = await request.body()
+        return dict(parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True))
+    return await request.form()
@@ -0,0 +1,53 @@
+"""
+Conteo de tokens y recorte del historial a un presupuesto.
+
+Un solo encoder de tiktoken por proceso; los conteos se cachean por texto,
+así el system prompt y los mensajes del historial se tokenizan una vez.
+"""
+
+from functools import lru_cache
+
+import tiktoken
+
+from app.core.config import settings
+
+
+# Tokens extra que OpenAI suma por cada mensaje del chat (rol y separadores)
+TOKENS_PER_MESSAGE = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding() -> tiktoken.Encoding:
+    """Encoder del modelo configurado (cl100k_base si tiktoken no lo conoce)."""
+    try:
+        return tiktoken.encoding_for_model(settings.openai_model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """Tokens de un texto, cacheado por contenido."""
+    return len(get_encoding().encode(text)) + TOKENS_PER_MESSAGE
+
+
+def truncate_history(history: list, budget: int) -> list:
+    """
+    Retorna el sufijo más largo del historial que cabe en `budget` tokens.
+    
+    Con los conteos cacheados basta una pasada desde el mensaje más reciente;
+    los mensajes viejos se descartan en bloque con un solo slice.
+    """
+    if not history:
+        return history
+    
+    used = 0
+    start = len(history)
+    while start > 0:
+        cost = count_tokens(history[start - 1]["content"])
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    
+    return history[start:] if start else history
@@ -0,0 +1,70 @@
+"""
+Worker de arq - Procesa mensajes encolados fuera del servidor web.
+
+Ejecutar con:
+    arq app.worker.WorkerSettings
+"""
+
+from contextlib import suppress
+import asyncio
+
+from arq import cron
+
+from app.core.cache_invalidation import run_invalidation_listener
+from app.core.logging_setup import configure_logging, start_log_listener, stop_log_listener
+from app.core.queue import get_redis_settings
+from app.schemas.message import NormalizedMessage
+from app.api.webhooks.whatsapp import process_and_respond_whatsapp
+from app.services.feedback_service import (
+    refresh_daily_metrics,
+    METRICS_BACKFILL_DAYS
+)
+
+
+async def process_whatsapp_job(ctx, message: dict, user_phone: str):
+    """Procesa un mensaje de WhatsApp encolado por el webhook."""
+    await process_and_respond_whatsapp(NormalizedMessage(**message), user_phone)
+
+
+async def refresh_daily_metrics_job(ctx):
+    """Recalcula el rollup de métricas de los últimos días (cron cada hora)."""
+    await refresh_daily_metrics()
+
+
+async def startup(ctx):
+    # Mismo logging que la API (cola + QueueListener, JSON con orjson en prod);
+    # se configura aquí porque el CLI de arq configura el suyo al arrancar
+    configure_logging()
+    start_log_listener()
+    # Los documentos cambian en la API: escuchar sus avisos de invalidación
+    ctx["invalidation_listener"] = asyncio.create_task(run_invalidation_listener())
+    await refresh_daily_metrics(METRICS_BACKFILL_DAYS)
+
+
+async def shutdown(ctx):
+    from app.core.database import close_db
+    from app.core.http import close_http_clients
+    from app.core.openai_client import close_openai_client
+    from app.services.database_service import flush_write_behind
+    from app.services.rag_service import close_qdrant
+    
+    listener = ctx.get("invalidation_listener")
+    if listener is not None:
+        listener.cancel()
+        with suppress(asyncio.CancelledError):
+            await listener
+    await flush_write_behind()
+    await close_db()
+    await close_http_clients()
+    await close_openai_client()
+    await close_qdrant()
+    stop_log_listener()
+
+
+class WorkerSettings:
+    functions = [process_whatsapp_job]
+    cron_jobs = [cron(refresh_daily_metrics_job, minute=5)]
+    redis_settings = get_redis_settings()
+    on_startup = startup
+    on_shutdown = shutdown
+    max_jobs = 20
\ No newline at end of file
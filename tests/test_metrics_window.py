@@ -0,0 +1,80 @@
+"""
+Límite entre el rollup daily_metrics y el conteo en vivo en
+get_conversation_metrics.
+"""
+
+from datetime import date, datetime, timedelta, timezone
+
+from app.services.feedback_service import _covered_until, _metrics_window
+
+TODAY = date(2026, 3, 10)
+
+
+def _at(day: date, hour: int = 0, minute: int = 0) -> datetime:
+    return datetime(day.year, day.month, day.day, hour, minute, tzinfo=timezone.utc)
+
+
+def test_no_rollup_rows_counts_whole_window_live():
+    covered = _covered_until(None, None)
+    assert covered is None
+    
+    window_start, rollup_until = _metrics_window(TODAY, 7, covered)
+    assert window_start == TODAY - timedelta(days=6)
+    assert rollup_until == window_start
+
+
+def test_rollup_up_to_date_covers_until_today():
+    # Refresco de hoy a las 00:05: guardó hasta ayer
+    covered = _covered_until(_at(TODAY, 0, 5), TODAY - timedelta(days=1))
+    assert covered == TODAY
+    
+    window_start, rollup_until = _metrics_window(TODAY, 7, covered)
+    assert rollup_until == TODAY
+
+
+def test_refresh_straddling_midnight_leaves_missing_day_live():
+    # El refresco calculó su "hoy" antes de la medianoche (guardó hasta
+    # anteayer) pero su transacción empezó ya en el día de hoy
+    yesterday = TODAY - timedelta(days=1)
+    covered = _covered_until(_at(TODAY, 0, 0), yesterday - timedelta(days=1))
+    assert covered == yesterday
+    
+    _, rollup_until = _metrics_window(TODAY, 7, covered)
+    assert rollup_until == yesterday
+
+
+def test_updated_at_is_compared_in_utc():
+    # 20:00 en UTC-5 del día anterior ya es el día de hoy en UTC
+    local = datetime(2026, 3, 9, 20, 0, tzinfo=timezone(timedelta(hours=-5)))
+    assert _covered_until(local, TODAY - timedelta(days=1)) == TODAY
+
+
+def test_idle_company_counts_days_after_last_row_live():
+    # Sin actividad en los últimos días: el rollup no tiene filas para ellos
+    last_day = TODAY - timedelta(days=4)
+    covered = _covered_until(_at(TODAY, 0, 5), last_day)
+    assert covered == TODAY - timedelta(days=3)
+    
+    window_start, rollup_until = _metrics_window(TODAY, 7, covered)
+    assert window_start < rollup_until < TODAY
+    assert rollup_until == TODAY - timedelta(days=3)
+
+
+def test_idle_longer_than_window_counts_whole_window_live():
+    covered = _covered_until(_at(TODAY - timedelta(days=20)), TODAY - timedelta(days=30))
+    
+    window_start, rollup_until = _metrics_window(TODAY, 7, covered)
+    assert rollup_until == window_start
+
+
+def test_single_day_window_is_live_only():
+    covered = _covered_until(_at(TODAY, 0, 5), TODAY - timedelta(days=1))
+    
+    window_start, rollup_until = _metrics_window(TODAY, 1, covered)
+    assert window_start == TODAY
+    assert rollup_until == TODAY
+
+
+def test_rollup_never_covers_today():
+    window_start, rollup_until = _metrics_window(TODAY, 7, TODAY + timedelta(days=1))
+    assert rollup_until == TODAY